@@ -0,0 +1,193 @@
+#!/bin/env python3
+import argparse
+import collections
+import contextlib
+import csv
+import glob
+import json
+import os, sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import ReadSurvey as RS
+import SurveyRules
+
+# Times a survey is submitted to a fresh pool after a worker died
+# under it, before it's reported as an error
+max_attempts = 3
+
+def FindSurveys(stave_paths):
+    "(stave path, module number, file) for every ModulePlacement/<n>/Module_<n>.txt"
+    found = []
+    for stave in stave_paths:
+        pattern = os.path.join(stave, "ModulePlacement", "*", "Module_*.txt")
+        for path in glob.glob(pattern):
+            num = os.path.basename(os.path.dirname(path))
+            if not num.isdigit() or os.path.basename(path) != "Module_%s.txt" % num:
+                continue
+            found.append((stave, int(num), path))
+    found.sort()
+    return found
+
+def AnalyseSurvey(stave, module, path, quiet = True, rules = None):
+    "Parse and evaluate one survey file, errors are reported in the entry"
+    entry = collections.OrderedDict()
+    entry["stave"] = stave
+    entry["module"] = module
+    entry["file"] = path
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            out = devnull if quiet else sys.stdout
+            with contextlib.redirect_stdout(out):
+                survey = RS.TheSurveys("Module" + str(module), os.path.basename(path),
+                                       os.path.dirname(path) + os.sep, rules)
+    except Exception as e:
+        entry["status"] = "error"
+        entry["error"] = "%s: %s" % (type(e).__name__, e)
+        return entry
+
+    deltas = survey.Deltas()
+    entry["status"] = "ok"
+    entry["stages"] = survey.stages
+    entry["glued"] = survey.glued
+    entry["passed"] = survey.passed
+    entry["gluetime"] = survey.gluetime
+    entry["failures"] = survey.failures
+    entry["failure_records"] = survey.failure_records
+    entry["max_delta"] = [float(abs(deltas[:, :, xyz]).max()) if deltas.size else 0.
+                          for xyz in range(2)]
+    entry["deltas"] = collections.OrderedDict()
+    for ind, stage in enumerate(survey.stages):
+        entry["deltas"][stage] = collections.OrderedDict(
+            (corner, [round(float(d), 3) for d in deltas[ind, c]])
+            for c, corner in enumerate(survey.corners.keys()))
+    return entry
+
+def ErrorEntry(stave, module, path, e):
+    return collections.OrderedDict([("stave", stave), ("module", module),
+                                    ("file", path), ("status", "error"),
+                                    ("error", "%s: %s" % (type(e).__name__, e))])
+
+def AnalyseAll(surveys, jobs = None, max_errors = None, quiet = True, rules = None):
+    """Evaluate surveys on a process pool, return report entries in input order
+
+    If a worker dies (eg. out of memory) the pool is broken, and every
+    survey not yet finished is resubmitted to a new one"""
+    entries = [None] * len(surveys)
+    attempts = [0] * len(surveys)
+    errors = 0
+    done = 0
+    stop = False
+    start = time.time()
+
+    pending = list(range(len(surveys)))
+    while pending and not stop:
+        broken = []
+        pool = ProcessPoolExecutor(max_workers = jobs)
+        try:
+            futures = {}
+            for pos, ind in enumerate(pending):
+                stave, module, path = surveys[ind]
+                try:
+                    future = pool.submit(AnalyseSurvey, stave, module, path, quiet, rules)
+                except BrokenProcessPool:
+                    broken.extend(pending[pos:])
+                    break
+                futures[future] = ind
+                attempts[ind] += 1
+
+            for future in as_completed(futures):
+                ind = futures[future]
+                stave, module, path = surveys[ind]
+                try:
+                    entry = future.result()
+                except BrokenProcessPool as e:
+                    if attempts[ind] < max_attempts:
+                        broken.append(ind)
+                        continue
+                    entry = ErrorEntry(stave, module, path, e)
+                except Exception as e:
+                    entry = ErrorEntry(stave, module, path, e)
+                entries[ind] = entry
+                done += 1
+
+                if entry["status"] == "error":
+                    errors += 1
+                    print("[%i/%i] %s: %s" % (done, len(surveys), path, entry["error"]))
+                    if max_errors is not None and errors >= max_errors:
+                        print("Too many errors (%i), stopping" % errors)
+                        for f in futures:
+                            f.cancel()
+                        stop = True
+                        break
+                elif not quiet or done % 100 == 0 or done == len(surveys):
+                    print("[%i/%i] %.1fs" % (done, len(surveys), time.time() - start))
+        finally:
+            pool.shutdown()
+
+        pending = sorted(broken)
+        if pending and not stop:
+            print("Worker process died, restarting the pool for %i surveys" % len(pending))
+
+    return [e for e in entries if e is not None]
+
+def WriteReport(entries, fname):
+    if fname.endswith(".csv"):
+        with open(fname, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stave", "module", "status", "glued", "passed",
+                             "failures", "max_dX_um", "max_dY_um", "error"])
+            for e in entries:
+                if e["status"] == "ok":
+                    writer.writerow([e["stave"], e["module"], e["status"], e["glued"],
+                                     e["passed"], len(e["failures"]),
+                                     e["max_delta"][0], e["max_delta"][1], ""])
+                else:
+                    writer.writerow([e["stave"], e["module"], e["status"],
+                                     "", "", "", "", "", e["error"]])
+    else:
+        with open(fname, "w") as f:
+            json.dump(entries, f, indent = 1)
+
+def PrintSummary(entries):
+    ok = [e for e in entries if e["status"] == "ok"]
+    passed = len([e for e in ok if e["passed"]])
+    print('')
+    print('----------------------------------------')
+    print("%i surveys: %i passed, %i failed, %i could not be read"
+          % (len(entries), passed, len(ok) - passed, len(entries) - len(ok)))
+    print('----------------------------------------')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'evaluate every module survey under some staves')
+
+    parser.add_argument('stave_paths', nargs = '+', help = 'stave directories containing ModulePlacement/')
+    parser.add_argument('--output', '-o', dest = 'output', type = str, default = 'survey_report.json',
+                        help = 'report file, .json for everything or .csv for one line per module')
+    parser.add_argument('--jobs', '-j', dest = 'jobs', type = int, default = None,
+                        help = 'number of worker processes (default: number of CPUs)')
+    parser.add_argument('--max-errors', dest = 'max_errors', type = int, default = None,
+                        help = 'stop after this many unreadable surveys (default: never stop)')
+    parser.add_argument('--rules', dest = 'rules', type = str, default = None,
+                        help = 'json rule set to check against, see SurveyRules.py (default: 25 um in X and Y)')
+    parser.add_argument('--verbose', action = 'store_true',
+                        help = 'show the output of each survey and progress of every file')
+
+    args = parser.parse_args()
+
+    surveys = FindSurveys(args.stave_paths)
+    if len(surveys) == 0:
+        print("No ModulePlacement/<n>/Module_<n>.txt found")
+        sys.exit(1)
+    print("Found %i surveys" % len(surveys))
+
+    rules = None
+    if args.rules:
+        rules = SurveyRules.RuleSet.Load(args.rules)
+
+    entries = AnalyseAll(surveys, args.jobs, args.max_errors, quiet = not args.verbose, rules = rules)
+    WriteReport(entries, args.output)
+    print("Report written to %s" % args.output)
+    PrintSummary(entries)
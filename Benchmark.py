@@ -0,0 +1,293 @@
+#!/bin/env python3
+import argparse
+import collections
+import contextlib
+import importlib
+import json
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import ReadSurvey as RS
+import SurveyRules
+
+# Timing of the survey and upload chain on synthetic surveys, so a
+# change can be checked against the numbers of earlier commits.
+#
+#   parse      TheSurveys of every file (reading, stages, default check)
+#   evaluate   the rule set, one survey at a time
+#   serialize  GetAGJSON/GetBBRJSON and printDict of the DTOs
+#   upload     uploadTestRunResults of every DTO to mockDB.py
+#
+# Each phase is timed --repeat times and the best kept, then run once
+# more under tracemalloc for its peak memory. Results are appended to
+# a json lines file, one line per run with the git commit.
+
+stage_names = ["Ideal", "After_Gluing", "Before_Bridge_Removal", "After_Bridge_Removal"]
+
+def StageNames(nstages):
+    "The usual stages, then extra ones, eg. After_Gluing_2"
+    names = stage_names[: nstages]
+    for ind in range(len(names), nstages):
+        names.append("After_Gluing_%i" % ind)
+    return names
+
+def WriteSurvey(fname, nstages = 4, rng = None, spread = 0.01):
+    "A survey file in the format of the OMNI output, with random positions"
+    if rng is None:
+        rng = np.random.RandomState(0)
+    stages = StageNames(nstages)
+    with open(fname, "w") as f:
+        f.write("Module survey\n")
+        f.write('Date_Survey = "10/05/2019 09:00:00.0000"\n')
+        for stage in stages:
+            f.write('Date_%s = "10/05/2019 12:30:45.1234"\n' % stage)
+        for corner in RS.corner_names:
+            f.write("\nCorner%s\n" % corner)
+            ideal = rng.uniform(-50, 50, 3)
+            for stage in stages:
+                xyz = ideal + rng.normal(0, spread, 3)
+                for dim, v in zip("XYZ", xyz):
+                    f.write("%s_%s = %.4f\n" % (dim, stage, v))
+
+def GenerateStaves(directory, staves = 1, modules = 13, nstages = 4, seed = 0):
+    """Stave trees of synthetic surveys and a component code file
+    under directory, returns [(stave path, module, file)]"""
+    rng = np.random.RandomState(seed)
+    surveys = []
+    for s in range(staves):
+        stave = os.path.join(directory, "Stave%i" % s) + os.sep
+        for module in range(1, modules + 1):
+            d = os.path.join(stave, "ModulePlacement", str(module))
+            os.makedirs(d)
+            fname = os.path.join(d, "Module_%i.txt" % module)
+            WriteSurvey(fname, nstages, rng)
+            surveys.append((stave, module, fname))
+    with open(os.path.join(directory, "comp_code.csv"), "w") as f:
+        f.write("Component_Code,Institution\n")
+        f.write("%032x,UNIA\n" % seed)
+    return surveys
+
+def Measure(function, repeat):
+    "Best wall time of repeat calls, and peak traced memory of one more"
+    times = []
+    result = None
+    for ind in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak, result
+
+def Quietly(function):
+    def quiet(*args, **kw):
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                return function(*args, **kw)
+    return quiet
+
+def RunBenchmarks(surveys, comp_code_path, repeat = 3, jobs = 4, upload = True, rules = None):
+    "Time each phase, returns {phase: result} in the order they ran"
+    upload_survey = importlib.import_module("uploadSurveyAG-BBR")
+    upload_survey.assemblers = "Benchmark"
+    upload_survey.site = "Benchmark"
+    import dbAccess
+    if rules is None:
+        rules = SurveyRules.RuleSet.Default()
+
+    results = collections.OrderedDict()
+
+    def Record(phase, items, elapsed, peak):
+        r = collections.OrderedDict()
+        r["items"] = items
+        r["seconds"] = round(elapsed, 6)
+        r["per_second"] = round(items / elapsed, 2) if elapsed > 0 else None
+        r["peak_kb"] = round(peak / 1024., 1)
+        results[phase] = r
+
+    @Quietly
+    def Parse():
+        return [RS.TheSurveys("Module" + str(module), os.path.basename(path),
+                              os.path.dirname(path) + os.sep)
+                for stave, module, path in surveys]
+    elapsed, peak, parsed = Measure(Parse, repeat)
+    Record("parse", len(surveys), elapsed, peak)
+
+    def Evaluate():
+        return [rules.Evaluate(s.coords, s.stages) for s in parsed]
+    elapsed, peak, ignore = Measure(Evaluate, repeat)
+    Record("evaluate", len(parsed), elapsed, peak)
+
+    @Quietly
+    def Serialize():
+        dtos = []
+        for (stave, module, path), survey in zip(surveys, parsed):
+            for GetJSON in [upload_survey.GetAGJSON, upload_survey.GetBBRJSON]:
+                dto = json.loads(GetJSON(survey, module, comp_code_path))
+                dbAccess.printDict(dto)
+                dtos.append(dto)
+        return dtos
+    elapsed, peak, dtos = Measure(Serialize, repeat)
+    Record("serialize", len(dtos), elapsed, peak)
+
+    if upload:
+        Record("upload", *UploadToMock(dtos, repeat, jobs))
+
+    return results
+
+def UploadToMock(dtos, repeat, jobs):
+    "Send the DTOs to an in-process mockDB, returns (items, time, peak)"
+    import dbAccess
+    import mockDB
+
+    server = mockDB.StartServer()
+    url = "http://127.0.0.1:%d/" % server.server_port
+    saved = (dbAccess.db_url, dbAccess.auth_url, dbAccess.tokenManager.fname, dbAccess.token)
+    token_dir = tempfile.mkdtemp()
+    try:
+        dbAccess.db_url = dbAccess.auth_url = url
+        dbAccess.tokenManager.fname = os.path.join(token_dir, "token")
+        dbAccess.token = Quietly(dbAccess.authenticate)("benchmark", "benchmark")
+        dbAccess.setupSession(pool_size = max(jobs, dbAccess.pool_size))
+
+        @Quietly
+        def Upload():
+            return dbAccess.doConcurrent(
+                lambda dto: dbAccess.doSomething("uploadTestRunResults", dto, method = "POST"),
+                [(dto,) for dto in dtos], jobs)
+        elapsed, peak, ignore = Measure(Upload, repeat)
+        return len(dtos), elapsed, peak
+    finally:
+        dbAccess.db_url, dbAccess.auth_url, dbAccess.tokenManager.fname, dbAccess.token = saved
+        shutil.rmtree(token_dir)
+        server.shutdown()
+        server.server_close()
+
+def GitCommit():
+    "Current commit, with +dirty if there are local changes"
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                         cwd = here, stderr = subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd = here,
+                                stderr = subprocess.DEVNULL) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+dirty" if dirty else "")
+
+def LoadResults(fname):
+    runs = []
+    try:
+        with open(fname) as f:
+            for line in f:
+                if line.strip():
+                    runs.append(json.loads(line))
+    except (IOError, OSError):
+        pass
+    return runs
+
+def FindBaseline(runs, config, commit = None):
+    "Latest earlier run with the same configuration (and commit, if given)"
+    for run in reversed(runs):
+        if run["config"] != config:
+            continue
+        if commit is None or run["commit"] is not None and run["commit"].startswith(commit):
+            return run
+    return None
+
+def PrintResults(run, baseline = None):
+    print("Benchmark at %s (%s)" % (run["commit"], ", ".join("%s=%s" % kv for kv in run["config"].items())))
+    if baseline is not None:
+        print("compared with %s from %s" % (baseline["commit"], baseline["date"]))
+    print("%-10s %8s %10s %12s %10s %s" % ("phase", "items", "seconds", "items/s", "peak kB",
+                                            "change" if baseline else ""))
+    for phase, r in run["results"].items():
+        change = ""
+        if baseline is not None and phase in baseline["results"]:
+            before = baseline["results"][phase]["per_second"]
+            if before and r["per_second"]:
+                change = "%+.1f%%" % (100. * (r["per_second"] / before - 1))
+        print("%-10s %8i %10.4f %12.1f %10.1f %s" % (phase, r["items"], r["seconds"],
+                                                     r["per_second"] or 0, r["peak_kb"], change))
+
+def Slower(run, baseline, max_slowdown):
+    "Phases whose throughput dropped by more than max_slowdown percent"
+    slower = []
+    for phase, r in run["results"].items():
+        before = baseline["results"].get(phase, {}).get("per_second")
+        if before and r["per_second"] and 100. * (1 - r["per_second"] / before) > max_slowdown:
+            slower.append(phase)
+    return slower
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'time parsing, evaluation, serialization and upload of surveys')
+
+    parser.add_argument('--staves', dest = 'staves', type = int, default = 4,
+                        help = 'number of synthetic staves')
+    parser.add_argument('--modules', dest = 'modules', type = int, default = 13,
+                        help = 'modules per stave')
+    parser.add_argument('--stages', dest = 'stages', type = int, default = 4,
+                        help = 'survey stages per module (more than 4 adds After_Gluing_<n>)')
+    parser.add_argument('--repeat', dest = 'repeat', type = int, default = 3,
+                        help = 'time each phase this many times and keep the best')
+    parser.add_argument('--jobs', '-j', dest = 'jobs', type = int, default = 4,
+                        help = 'concurrent uploads')
+    parser.add_argument('--no-upload', dest = 'upload', action = 'store_false',
+                        help = 'skip the upload to the mock DB')
+    parser.add_argument('--results', dest = 'results', type = str, default = 'benchmark_results.jsonl',
+                        help = 'json lines file to append the results to')
+    parser.add_argument('--no-save', dest = 'save', action = 'store_false',
+                        help = 'don\'t append these results')
+    parser.add_argument('--baseline', dest = 'baseline', type = str, default = None,
+                        help = 'commit to compare with (default: the last run with the same options)')
+    parser.add_argument('--max-slowdown', dest = 'max_slowdown', type = float, default = None,
+                        help = 'exit with an error if any phase is this many percent slower than the baseline')
+
+    args = parser.parse_args()
+
+    config = collections.OrderedDict([("staves", args.staves), ("modules", args.modules),
+                                      ("stages", args.stages), ("repeat", args.repeat),
+                                      ("jobs", args.jobs), ("upload", args.upload)])
+
+    directory = tempfile.mkdtemp(prefix = "survey_benchmark")
+    try:
+        surveys = GenerateStaves(directory, args.staves, args.modules, args.stages)
+        results = RunBenchmarks(surveys, os.path.join(directory, "comp_code.csv"),
+                                args.repeat, args.jobs, args.upload)
+    finally:
+        shutil.rmtree(directory)
+
+    run = collections.OrderedDict()
+    run["commit"] = GitCommit()
+    run["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    run["python"] = sys.version.split()[0]
+    run["config"] = config
+    run["results"] = results
+
+    runs = LoadResults(args.results)
+    baseline = FindBaseline(runs, json.loads(json.dumps(config)), args.baseline)
+    if args.baseline is not None and baseline is None:
+        print("No run of %s with these options in %s" % (args.baseline, args.results))
+
+    PrintResults(run, baseline)
+
+    if args.save:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(run) + "\n")
+
+    if args.max_slowdown is not None and baseline is not None:
+        slower = Slower(run, baseline, args.max_slowdown)
+        if slower:
+            print("Slower than %s by more than %.0f%%: %s" % (baseline["commit"], args.max_slowdown,
+                                                            ", ".join(slower)))
+            sys.exit(1)
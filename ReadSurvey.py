@@ -1,10 +1,18 @@
 #!/bin/env python3
 import numpy as np
+import array
 #import matplotlib.pyplot as plt
 #from mpl_toolkits.mplot3d import Axes3D
 import collections
 import argparse
 #import pandas as pd
+import SurveyRules
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Python 2
+    from collections import Mapping
 
 
 def StringtoFlt(string):
@@ -19,6 +27,96 @@ def StringtoFlt(string):
         print("Cannot convert string to float!")
     return flt
 
+corner_names = ['A', 'B', 'C', 'D']
+
+def StageKey(line):
+    "Stage part of a survey line, eg. 'AfterGluing' from 'X_AfterGluing = 0.1'"
+    return line[line.find("_") + 1: line.find("=") - 1]
+
+def ParseValue(line):
+    "Value after the = in a survey line, NaN if not a number"
+    try:
+        return float(line[line.find("=") + 1:])
+    except ValueError:
+        return float("nan")
+
+def TokenizeSurvey(infile):
+    """Read a survey file once, line by line, generating
+
+    ("corner", name) at the start of each corner block
+    ("date", line) for each Date_ line
+    ("value", corner, stage key, value) for each line of a corner block
+
+    The line just before a corner header (a separator) does not
+    belong to the previous block.
+    """
+    corner = None
+    held = None
+    for line in infile:
+        if ("Date_" in line):
+            yield ("date", line)
+
+        header = None
+        for name in corner_names:
+            if ("Corner" + name in line):
+                header = name
+                break
+
+        if header is not None:
+            held = None
+            corner = header
+            yield ("corner", corner)
+            continue
+
+        if corner is not None:
+            if held is not None:
+                yield held
+            held = ("value", corner, StageKey(line), ParseValue(line))
+
+    if held is not None:
+        yield held
+
+class SurveyResults(Mapping):
+    """Read-only view of a (stage, corner, xyz) array as the old
+    results[stage][corner] = [x, y, z] nested dicts
+
+    As with the dicts, a stage surveyed more than once (eg. both
+    Before_Bridge_Removal surveys are BBR) gives the last survey."""
+    def __init__(self, coords, stages, corners):
+        self.coords = coords
+        self.stages = stages
+        self.corners = corners
+        self.last = collections.OrderedDict()
+        for ind, stage in enumerate(stages):
+            self.last[stage] = ind
+
+    def __getitem__(self, stage):
+        try:
+            ind = self.last[stage]
+        except KeyError:
+            raise KeyError(stage)
+        result = collections.OrderedDict()
+        for c, corner in enumerate(self.corners):
+            result[corner] = self.coords[ind, c].tolist()
+        return result
+
+    def __iter__(self):
+        return iter(self.last)
+
+    def __len__(self):
+        return len(self.last)
+
+def CheckTolerance(coords, stages, tolerance):
+    "Whether X and Y stayed within tolerance um of the first stage, and failures"
+    passed, records = SurveyRules.RuleSet.Default(tolerance).Evaluate(coords, stages)
+    return passed, [SurveyRules.FormatFailure(f) for f in records]
+
+def WasGlued(stages):
+    glued=True
+    if "AG" not in stages and "ABR" not in stages and "BBR" not in stages:
+        glued=False
+    return glued
+
 def RepealAndReplace(string, repeal, replace = 1):
     if (repeal in string):
         ind = string.index(repeal)
@@ -53,51 +151,48 @@ def RenameStages(stages):
     return output
 
 class TheSurveys(object):
-    def __init__(self, name, infile, dir):
+    def __init__(self, name, infile, dir, rules = None):
         self.name = name
         self.infile = dir + infile
-        self.lines = self.GetLines()
-        self.corners = self.SeparateByCorner()
+        self.corners, self.stagekeys, self.dates = self.ReadFile()
         self.stages = self.GetStages()
         self.gluetime=self.GetGlueTime()
+        self.coords = self.GetCoords()
         self.results = self.GetResults()
         self.tolerance = 25
+        self.rules = rules if rules is not None else SurveyRules.RuleSet.Default(self.tolerance)
         self.passed, self.failures = self.DidItPass()
         self.glued = self.WasItGlued()
 
-    def GetLines(self):
+    def ReadFile(self):
+        "Values of each corner, stage keys of corner A and the date lines"
+        values = collections.OrderedDict((corner, array.array('d')) for corner in corner_names)
+        stagekeys = []
+        dates = []
+
         input = open(self.infile,"r")
-        lines = input.readlines()
+        for token in TokenizeSurvey(input):
+            if token[0] == "value":
+                kind, corner, stage, value = token
+                values[corner].append(value)
+                if corner == 'A' and stage not in stagekeys:
+                    stagekeys.append(stage)
+            elif token[0] == "date":
+                dates.append(token[1])
+            elif token[0] == "corner":
+                # Only the last block for each corner counts
+                values[token[1]] = array.array('d')
+                if token[1] == 'A':
+                    stagekeys = []
         input.close()
-        return lines
-
-    def SeparateByCorner(self):
-        indA, indB, indC, indD = 0, 0, 0, 0
-        for ind, line in enumerate(self.lines):
-            if ("CornerA" in line):
-                indA = ind + 1
-            elif ("CornerB" in line):
-                indB = ind + 1
-            elif ("CornerC" in line):
-                indC = ind + 1
-            elif ("CornerD" in line):
-                indD = ind + 1
 
         corners = collections.OrderedDict()
-        corners['A'] = self.lines[indA : indB - 2]
-        corners['B'] = self.lines[indB : indC - 2]
-        corners['C'] = self.lines[indC : indD - 2]
-        corners['D'] = self.lines[indD : ]
-
-        return corners
+        for corner, v in values.items():
+            corners[corner] = np.frombuffer(v, dtype = float) if len(v) else np.empty(0)
+        return corners, stagekeys, dates
 
     def GetStages(self):
-        stages = []
-        for line in self.corners['A']:
-            stage = line[line.find("_") + 1: line.find("=") - 1]
-            if (stage not in stages):
-                stages.append(stage)
-        stages = RenameStages(stages)
+        stages = RenameStages(self.stagekeys)
         if "AG" not in stages:
             print("WARNING: no AG for %s." %self.name)
         if "BBR" not in stages:
@@ -107,11 +202,7 @@ class TheSurveys(object):
         return stages
 
     def GetGlueTime(self):
-        DateAndTime = []
-        for line in self.lines:
-            if ("Date_" in line):
-                DateAndTime.append(line)
-        #print DateAndTime
+        DateAndTime = self.dates
         allstages=self.stages
         if "AG" in allstages:
             ind=allstages.index("AG") +1
@@ -124,53 +215,157 @@ class TheSurveys(object):
         return gluetime
 
 
-    def GetResults(self):
-        results = collections.OrderedDict()
-
-        for ind, stage in enumerate(self.stages):
-            results[stage] = collections.OrderedDict()
-            for corner in self.corners.keys():
-                results[stage][corner] = []
-                for xyz in range(3):
-                    pos = StringtoFlt(self.corners[corner][(3 * ind) + xyz])
-                    results[stage][corner].append(pos)
-        return results
+    def GetCoords(self):
+        nvalues = 3 * len(self.stages)
+        coords = np.empty((len(self.stages), len(self.corners), 3))
+        for c, corner in enumerate(self.corners.keys()):
+            coords[:, c, :] = self.corners[corner][0 : nvalues].reshape(-1, 3)
+        if not np.isfinite(coords).all():
+            stage, c, xyz = np.argwhere(~np.isfinite(coords))[0]
+            raise ValueError("Cannot convert string to float! (%s corner %s %s in %s)"
+                             % (self.stages[stage], corner_names[c], "XYZ"[xyz], self.infile))
+        return coords
 
+    def GetResults(self):
+        return SurveyResults(self.coords, self.stages, list(self.corners.keys()))
 
+    def Deltas(self, reference = 0):
+        "Movement in um of every stage, corner and xyz from the reference stage"
+        return 1000 * (self.coords - self.coords[reference])
 
     def DidItPass(self):
-        dims = ['X', 'Y']
-        passed = True
-        failures = []
-        for xyz, dim in enumerate(dims):
-            for corner in self.corners.keys():
-                for stage in self.stages:
-                    movement = 1000 * (self.results[stage][corner][xyz] - self.results[self.stages[0]][corner][xyz])
-                    if (abs(movement) >= self.tolerance):
-                        passed = False
-                        failures.append(corner + ' - ' + stage + ': delta' + dim + ' = ' + str(movement) + ' um')
-        return passed, failures
+        "Check against the rules, failure_records has the details"
+        self.passed, self.failure_records = self.rules.Evaluate(self.coords, self.stages)
+        return self.passed, [SurveyRules.FormatFailure(f) for f in self.failure_records]
 
     def WasItGlued(self):
-        glued=True
-        stages=self.stages
-        if "AG" not in stages and "ABR" not in stages and "BBR" not in stages:
-            glued=False
-        return glued
+        return WasGlued(self.stages)
+
+    def ToDict(self):
+        "Parsed and evaluated survey as plain json-able data"
+        return collections.OrderedDict([
+            ("name", self.name),
+            ("infile", self.infile),
+            ("stagekeys", self.stagekeys),
+            ("stages", self.stages),
+            ("gluetime", self.gluetime),
+            ("coords", self.coords.tolist()),
+            ("tolerance", self.tolerance),
+            ("passed", self.passed),
+            ("failures", self.failures),
+            ("failure_records", self.failure_records),
+            ("glued", self.glued)])
+
+    @classmethod
+    def FromDict(cls, d):
+        "Survey from ToDict output, without reading the file again"
+        survey = cls.__new__(cls)
+        survey.name = d["name"]
+        survey.infile = d["infile"]
+        survey.stagekeys = d["stagekeys"]
+        survey.stages = d["stages"]
+        survey.dates = []
+        survey.gluetime = d["gluetime"]
+        survey.coords = np.array(d["coords"], dtype = float).reshape(len(survey.stages), len(corner_names), 3)
+        survey.corners = collections.OrderedDict(
+            (corner, survey.coords[:, c, :].ravel()) for c, corner in enumerate(corner_names))
+        survey.results = survey.GetResults()
+        survey.tolerance = d["tolerance"]
+        survey.passed = d["passed"]
+        survey.failures = d["failures"]
+        survey.failure_records = d.get("failure_records", [])
+        survey.rules = SurveyRules.RuleSet.Default(survey.tolerance)
+        survey.glued = d["glued"]
+        return survey
 
     def PrintTheFailures(self):
         print('')
         print('----------------------------------------')
+        rules = getattr(self, "rules", None)
+        default = rules is None or rules is SurveyRules.RuleSet.Default(self.tolerance)
         if self.passed:
-            print("Passed! All surveys within " + str(self.tolerance) + " um tolerance.")
+            if default:
+                print("Passed! All surveys within " + str(self.tolerance) + " um tolerance.")
+            else:
+                print("Passed! All surveys pass the rules.")
         else:
-            print("Failed! The following corners are out of " + str(self.tolerance) + " um tolerance: ")
+            if default:
+                print("Failed! The following corners are out of " + str(self.tolerance) + " um tolerance: ")
+            else:
+                print("Failed! The following are out of their limits: ")
             for failure in self.failures:
                 print(failure)
         print('----------------------------------------')
         print('')
 
 
+class SurveyRecord(object):
+    """Compact, read-only survey for keeping many in memory
+
+    Only the (stage, corner, xyz) array and a few scalars are kept, the
+    same attributes as TheSurveys are computed from them when used.
+    """
+    __slots__ = ("name", "infile", "gluetime", "tolerance", "rules",
+                 "_stages", "_coords", "_evaluation")
+
+    corners = collections.OrderedDict((corner, c) for c, corner in enumerate(corner_names))
+
+    def __init__(self, name, infile, stages, coords, gluetime, tolerance = 25, rules = None):
+        self.name = name
+        self.infile = infile
+        self._stages = tuple(stages)
+        self._coords = np.ascontiguousarray(coords, dtype = float).reshape(len(self._stages), len(corner_names), 3)
+        self.gluetime = gluetime
+        self.tolerance = tolerance
+        self.rules = rules if rules is not None else SurveyRules.RuleSet.Default(tolerance)
+        self._evaluation = None
+
+    @classmethod
+    def FromSurvey(cls, survey):
+        return cls(survey.name, survey.infile, survey.stages, survey.coords,
+                   survey.gluetime, survey.tolerance, getattr(survey, "rules", None))
+
+    @classmethod
+    def FromFile(cls, name, infile, dir, rules = None):
+        "Parse a survey file, keeping only the record"
+        return cls.FromSurvey(TheSurveys(name, infile, dir, rules))
+
+    @property
+    def stages(self):
+        return list(self._stages)
+
+    @property
+    def coords(self):
+        return self._coords
+
+    @property
+    def results(self):
+        return SurveyResults(self._coords, self._stages, corner_names)
+
+    def Evaluate(self):
+        if self._evaluation is None:
+            passed, records = self.rules.Evaluate(self._coords, self._stages)
+            self._evaluation = (passed, [SurveyRules.FormatFailure(f) for f in records])
+        return self._evaluation
+
+    @property
+    def passed(self):
+        return self.Evaluate()[0]
+
+    @property
+    def failures(self):
+        return self.Evaluate()[1]
+
+    @property
+    def glued(self):
+        return WasGlued(self._stages)
+
+    def Deltas(self, reference = 0):
+        return 1000 * (self._coords - self._coords[reference])
+
+    def PrintTheFailures(self):
+        TheSurveys.PrintTheFailures(self)
+
 if __name__ == '__main__':
 
     # Define our parser
@@ -181,6 +376,8 @@ if __name__ == '__main__':
     #required = parser.add_argument_group('required arguments')
     parser.add_argument('--surveyPath', dest = 'survey_path', type = str, help = 'path to the survey')
     parser.add_argument('--module-num', dest= 'module_num',type=int,help='read survey file of this module')
+    parser.add_argument('--rules', dest = 'rules', type = str, default = None,
+                        help = 'json rule set to check against, see SurveyRules.py (default: 25 um in X and Y)')
     # Define our optional arguments
     #optional = parser.add_argument_group('optional arguments')
 
@@ -188,9 +385,13 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    rules = None
+    if args.rules:
+        rules = SurveyRules.RuleSet.Load(args.rules)
+
     modules = [args.module_num]
     for module in modules:
-        survey = TheSurveys("Module" + str(module), "Module_" + str(module) + ".txt",args.survey_path)
+        survey = TheSurveys("Module" + str(module), "Module_" + str(module) + ".txt",args.survey_path, rules)
 
         print(survey.name)
         print(survey.infile)
@@ -4,7 +4,9 @@ import argparse
 import json
 import time
 #import os, sys,
+import os
 import ReadSurvey as RS
+import SurveyManifest
 
 def ReadLines(infile):
     input = open(infile,"r")
@@ -56,19 +58,39 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'read a survey file')
 
     parser.add_argument('--surveyPath', dest = 'survey_path', type = str, help = 'path to the survey')
-    parser.add_argument('--module-num', dest= 'module_num',type=str,help='read survey file of these module, ex. 3,4,5')
+    parser.add_argument('--module-num', dest= 'module_num',type=str,help='read survey file of these module, ex. 3,4,5, or "all"')
 
     parser.add_argument('--compCodePath',dest='comp_code_path',type=str,help='path to find component code')
+    parser.add_argument('--incremental', dest = 'incremental', action = 'store_true',
+                        help = 'reuse the parsed results of surveys unchanged since the last run')
+    parser.add_argument('--manifest', dest = 'manifest_path', type = str, default = None,
+                        help = 'manifest file for --incremental (default: .survey_manifest.json in --surveyPath)')
     #optional.add_argument('--getConfirm', dest = 'confirm', action = 'store_true', help = 'print survey stages')
 
     args = parser.parse_args()
 
-    modules = [int(x) for x in args.module_num.split(",")]
+    if args.module_num != "all":
+        modules = [int(x) for x in args.module_num.split(",")]
+    else:
+        modules = range(1,14)
+
+    manifest = None
+    if args.incremental:
+        manifest = SurveyManifest.SurveyManifest(args.manifest_path or
+                                                 os.path.join(args.survey_path, SurveyManifest.default_name))
 
     for module in modules:
-        survey = RS.TheSurveys("Module" + str(module),"Module_" + str(module) + ".txt",
-                    args.survey_path+"ModulePlacement/"+str(module)+"/")
+        name, infile, dir = ("Module" + str(module),"Module_" + str(module) + ".txt",
+                             args.survey_path+"ModulePlacement/"+str(module)+"/")
+        if manifest is not None:
+            survey = manifest.LoadSurvey(name, infile, dir)
+        else:
+            survey = RS.TheSurveys(name, infile, dir)
         print(survey.name)
         print(survey.infile)
         survey.PrintTheFailures()
         SaveJSON(survey,module,args.comp_code_path)
+
+    if manifest is not None:
+        manifest.Save()
+        manifest.PrintStats()
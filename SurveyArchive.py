@@ -0,0 +1,225 @@
+#!/bin/env python3
+import argparse
+import contextlib
+import json
+import os, sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import ReadSurvey as RS
+import BatchSurvey
+
+# Append-only columnar store of parsed surveys, so trend studies over
+# every module ever surveyed don't have to parse the text files again.
+#
+# An archive is a directory of flat little-endian arrays, all opened
+# with np.memmap:
+#   modules.bin  one module_dtype record per survey
+#   stages.bin   int16 stage code for each (module, stage) row
+#   coords.bin   float64 (corner, xyz) positions for each row
+# and index.json, with the stage and stave names that the codes refer
+# to, and how many records and rows are valid. A stave is named by its
+# path relative to the directory holding the archive, so staves of the
+# same name at different sites are kept apart. index.json is written
+# last, so a half-finished append is ignored (and overwritten next time).
+
+module_dtype = np.dtype([("stave", "<i4"), ("module", "<i4"),
+                         ("first_row", "<i8"), ("nstages", "<i2"),
+                         ("passed", "u1"), ("glued", "u1"),
+                         ("gluetime", "S32")])
+stage_dtype = np.dtype("<i2")
+coord_dtype = np.dtype("<f8")
+ncorners = len(RS.corner_names)
+
+class SurveyArchive(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {"version": 1, "stages": [], "staves": [], "modules": 0, "rows": 0}
+        try:
+            with open(self.Path("index.json")) as f:
+                self.index = json.load(f)
+        except (IOError, OSError):
+            pass
+        self.Open()
+
+    def Path(self, name):
+        return os.path.join(self.directory, name)
+
+    def StaveName(self, stave):
+        "Name in the archive of a stave directory"
+        root = os.path.dirname(os.path.abspath(self.directory))
+        name = os.path.relpath(os.path.abspath(stave), root)
+        return name.replace(os.sep, "/")
+
+    def Map(self, name, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype = dtype)
+        return np.memmap(self.Path(name), dtype = dtype, mode = "r", shape = shape)
+
+    def Open(self):
+        "Map the valid part of each column"
+        self.modules = self.Map("modules.bin", module_dtype, (self.index["modules"],))
+        self.stages = self.Map("stages.bin", stage_dtype, (self.index["rows"],))
+        self.coords = self.Map("coords.bin", coord_dtype, (self.index["rows"], ncorners, 3))
+
+    def __len__(self):
+        return self.index["modules"]
+
+    def Code(self, table, name):
+        names = self.index[table]
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def Append(self, surveys):
+        "Add (stave name, module number, TheSurveys) entries to the end"
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        nmodules = self.index["modules"]
+        nrows = self.index["rows"]
+
+        records = np.zeros(len(surveys), dtype = module_dtype)
+        stages = []
+        coords = []
+        row = nrows
+        for ind, (stave, module, survey) in enumerate(surveys):
+            n = len(survey.stages)
+            records[ind] = (self.Code("staves", stave), module, row, n,
+                            survey.passed, survey.glued,
+                            survey.gluetime.encode("utf-8")[:32])
+            stages.extend(self.Code("stages", s) for s in survey.stages)
+            coords.append(np.asarray(survey.coords, dtype = coord_dtype).reshape(n, ncorners, 3))
+            row += n
+
+        # Drop anything written after the last complete append
+        for name, dtype, count in [("modules.bin", module_dtype, nmodules),
+                                   ("stages.bin", stage_dtype, nrows),
+                                   ("coords.bin", coord_dtype, nrows * ncorners * 3)]:
+            with open(self.Path(name), "ab") as f:
+                f.truncate(count * dtype.itemsize)
+
+        with open(self.Path("coords.bin"), "ab") as f:
+            for c in coords:
+                f.write(c.tobytes())
+        with open(self.Path("stages.bin"), "ab") as f:
+            f.write(np.array(stages, dtype = stage_dtype).tobytes())
+        with open(self.Path("modules.bin"), "ab") as f:
+            f.write(records.tobytes())
+
+        self.index["modules"] = nmodules + len(surveys)
+        self.index["rows"] = row
+        tmp = self.Path("index.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.rename(tmp, self.Path("index.json"))
+
+        self.Open()
+
+    def Find(self, stave = None, module = None):
+        "Indices of the records for a stave and/or module number"
+        mask = np.ones(len(self), dtype = bool)
+        if stave is not None:
+            if stave not in self.index["staves"]:
+                stave = self.StaveName(stave)
+            if stave not in self.index["staves"]:
+                return np.zeros(0, dtype = int)
+            mask &= self.modules["stave"] == self.index["staves"].index(stave)
+        if module is not None:
+            mask &= self.modules["module"] == module
+        return np.nonzero(mask)[0]
+
+    def Stages(self, ind):
+        r = self.modules[ind]
+        codes = self.stages[r["first_row"] : r["first_row"] + r["nstages"]]
+        return [self.index["stages"][c] for c in codes]
+
+    def Coords(self, ind):
+        "(stage, corner, xyz) positions of one record, as a view on the file"
+        r = self.modules[ind]
+        return self.coords[r["first_row"] : r["first_row"] + r["nstages"]]
+
+    def Record(self, ind):
+        r = self.modules[ind]
+        return {"stave": self.index["staves"][r["stave"]],
+                "module": int(r["module"]),
+                "stages": self.Stages(ind),
+                "coords": np.array(self.Coords(ind)),
+                "passed": bool(r["passed"]),
+                "glued": bool(r["glued"]),
+                "gluetime": r["gluetime"].decode("utf-8")}
+
+    def StageRows(self, stage):
+        "Index of the record and row of every module surveyed at stage"
+        if stage not in self.index["stages"]:
+            return np.zeros(0, dtype = int), np.zeros(0, dtype = int)
+        rows = np.nonzero(self.stages == self.index["stages"].index(stage))[0]
+        records = np.searchsorted(self.modules["first_row"], rows, side = "right") - 1
+        return records, rows
+
+    def LastStageRows(self, stage):
+        "StageRows with only the last row of each record, for a stage surveyed more than once"
+        records, rows = self.StageRows(stage)
+        records, first = np.unique(records[::-1], return_index = True)
+        return records, rows[::-1][first]
+
+    def Deltas(self, stage, reference):
+        """Movement in um from reference to stage for every module with
+        both, as (record indices, (module, corner, xyz) array)
+
+        Uses the last survey of each stage, as SurveyRules does"""
+        records, rows = self.LastStageRows(stage)
+        ref_records, ref_rows = self.LastStageRows(reference)
+        common, i, j = np.intersect1d(records, ref_records, return_indices = True)
+        return common, 1000 * (self.coords[rows[i]] - self.coords[ref_rows[j]])
+
+def ParseSurvey(stave, module, path):
+    "Parsed survey for archiving, None if it can't be read"
+    try:
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                return RS.TheSurveys("Module" + str(module), os.path.basename(path),
+                                     os.path.dirname(path) + os.sep)
+    except Exception as e:
+        print("Failed to read %s: %s" % (path, e))
+        return None
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'columnar archive of parsed surveys')
+
+    parser.add_argument('command', choices = ['add', 'info', 'show'])
+    parser.add_argument('stave_paths', nargs = '*', help = 'stave directories to add')
+    parser.add_argument('--archive', dest = 'archive', type = str, default = 'survey_archive',
+                        help = 'archive directory')
+    parser.add_argument('--stave', dest = 'stave', type = str, help = 'stave name or directory, to show')
+    parser.add_argument('--module-num', dest = 'module_num', type = int, help = 'module number, to show')
+    parser.add_argument('--jobs', '-j', dest = 'jobs', type = int, default = None,
+                        help = 'number of processes parsing surveys to add')
+
+    args = parser.parse_args()
+
+    archive = SurveyArchive(args.archive)
+
+    if args.command == 'add':
+        surveys = BatchSurvey.FindSurveys(args.stave_paths)
+        print("Parsing %i surveys" % len(surveys))
+        pool = ProcessPoolExecutor(max_workers = args.jobs)
+        try:
+            parsed = list(pool.map(ParseSurvey, *zip(*surveys), chunksize = 16)) if surveys else []
+        finally:
+            pool.shutdown()
+        entries = [(archive.StaveName(stave), module, survey)
+                   for (stave, module, path), survey in zip(surveys, parsed)
+                   if survey is not None]
+        archive.Append(entries)
+        print("Added %i surveys, %i in archive" % (len(entries), len(archive)))
+    elif args.command == 'info':
+        print("%i surveys, %i stage rows" % (len(archive), archive.index["rows"]))
+        print("Staves: %s" % ", ".join(archive.index["staves"]))
+        print("Stages: %s" % ", ".join(archive.index["stages"]))
+    else:
+        for ind in archive.Find(args.stave, args.module_num):
+            r = archive.Record(ind)
+            print("%s module %i: passed %s, glued at %s" % (r["stave"], r["module"], r["passed"], r["gluetime"]))
+            for stage, c in zip(r["stages"], r["coords"]):
+                print("  %s: %s" % (stage, c.tolist()))
@@ -0,0 +1,113 @@
+#!/bin/env python3
+import hashlib
+import json
+import os
+import threading
+import ReadSurvey as RS
+
+# Local record of the survey files already parsed (and uploaded), so
+# reruns over "all" modules only parse new or modified surveys.
+#
+# Each file is keyed on its absolute path, with its size, mtime and
+# sha1, the serialised TheSurveys and, for each test uploaded, a hash of
+# the file and of the upload (component code, institution, assemblers...).
+
+default_name = ".survey_manifest.json"
+
+# Increase when TheSurveys parses or evaluates differently, or ToDict
+# changes, so surveys kept by older versions are parsed again
+version = 2
+
+def FileHash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class SurveyManifest(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.files = {}
+        self.parsed = 0
+        self.reused = 0
+        try:
+            with open(fname) as f:
+                saved = json.load(f)
+            if saved.get("version") == version:
+                self.files = saved["files"]
+            else:
+                print("Survey manifest %s is from another version, parsing every survey again" % fname)
+        except (IOError, OSError):
+            pass
+        except (ValueError, KeyError):
+            print("Ignoring unreadable survey manifest %s" % fname)
+
+    def Current(self, path):
+        "Manifest entry for path if the file is unchanged, otherwise None"
+        path = os.path.abspath(path)
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+
+        st = os.stat(path)
+        if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return entry
+
+        # Touched, maybe not modified
+        if entry["size"] == st.st_size and entry["sha1"] == FileHash(path):
+            entry["mtime"] = st.st_mtime
+            return entry
+        return None
+
+    def LoadSurvey(self, name, infile, dir):
+        "TheSurveys from the manifest if the file is unchanged, else parse it"
+        path = os.path.abspath(dir + infile)
+        with self.lock:
+            entry = self.Current(path)
+        if entry is not None:
+            with self.lock:
+                self.reused += 1
+            return RS.TheSurveys.FromDict(entry["survey"])
+
+        sha1 = FileHash(path)
+        st = os.stat(path)
+        survey = RS.TheSurveys(name, infile, dir)
+        with self.lock:
+            self.parsed += 1
+            self.files[path] = {"size": st.st_size, "mtime": st.st_mtime, "sha1": sha1,
+                                "survey": survey.ToDict(), "uploaded": {}}
+        return survey
+
+    def UploadKey(self, entry, dto):
+        "Hash of the file and what was sent for it, except the date of upload"
+        dto = dict((k, v) for k, v in dto.items() if k != "date")
+        h = hashlib.sha1(entry["sha1"].encode("ascii"))
+        h.update(json.dumps(dto, sort_keys = True).encode("utf-8"))
+        return h.hexdigest()
+
+    def IsUploaded(self, survey, test, dto):
+        """Whether test was uploaded from the current content of the survey
+        file, with the same dto"""
+        path = os.path.abspath(survey.infile)
+        with self.lock:
+            entry = self.files.get(path)
+            return entry is not None and entry["uploaded"].get(test) == self.UploadKey(entry, dto)
+
+    def MarkUploaded(self, survey, test, dto):
+        path = os.path.abspath(survey.infile)
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None:
+                entry["uploaded"][test] = self.UploadKey(entry, dto)
+
+    def Save(self):
+        with self.lock:
+            tmp = "%s.%d.tmp" % (self.fname, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"version": version, "files": self.files}, f)
+            os.rename(tmp, self.fname)
+
+    def PrintStats(self):
+        print("Survey manifest: %i parsed, %i unchanged" % (self.parsed, self.reused))
@@ -0,0 +1,260 @@
+#!/bin/env python3
+import argparse
+import collections
+import json
+import numpy as np
+
+# Acceptance rules for module placement surveys.
+#
+# A rule set is declared as json, eg.
+#   {"reference": "Ideal",
+#    "rules": [
+#     {"name": "XY", "check": "position", "dims": ["X", "Y"], "limit": 25,
+#      "stage_limits": {"ABR": 30}, "corner_limits": {"D": 20}},
+#     {"name": "Z", "check": "position", "dims": ["Z"], "limit": 50, "stages": ["ABR"]},
+#     {"name": "rotation", "check": "rotation", "limit": 200},
+#     {"name": "offset", "check": "offset", "dims": ["X", "Y"], "limit": 15}]}
+#
+# position: movement of each corner from the reference stage, in um
+# rotation: best fit rotation of the four corners in XY, in urad
+# offset: movement of the centre of the four corners, in um
+#
+# Every rule may be limited to some "stages" and "corners" (position
+# only). stage_limits and corner_limits replace the limit for those
+# stages or corners, where both apply the smaller is used. A check
+# fails when |value| >= limit. Without a reference, movement is
+# measured from the first stage.
+
+corner_names = ['A', 'B', 'C', 'D']
+dim_names = ['X', 'Y', 'Z']
+
+class RuleSet(object):
+    # Default rule sets, by tolerance
+    defaults = {}
+
+    def __init__(self, rules, reference = None):
+        self.rules = []
+        for ind, rule in enumerate(rules):
+            rule = dict(rule)
+            rule.setdefault("name", "rule%i" % ind)
+            rule.setdefault("check", "position")
+            if rule["check"] not in ["position", "rotation", "offset"]:
+                raise ValueError("Unknown check '%s' in rule %s" % (rule["check"], rule["name"]))
+            rule.setdefault("dims", ["X", "Y"])
+            self.rules.append(rule)
+        self.reference = reference
+        self.compiled = {}
+
+    @classmethod
+    def Default(cls, tolerance = 25):
+        "X and Y of every corner within tolerance um of the first stage"
+        if tolerance not in cls.defaults:
+            cls.defaults[tolerance] = cls([{"name": "XY", "check": "position",
+                                            "dims": ["X", "Y"], "limit": tolerance}])
+        return cls.defaults[tolerance]
+
+    @classmethod
+    def Load(cls, fname):
+        with open(fname) as f:
+            spec = json.load(f)
+        return cls(spec["rules"], spec.get("reference"))
+
+    def Compile(self, stages):
+        """Limit arrays of each rule for this list of stages
+
+        position rules: (stage, corner, dim), other rules: (stage, dim),
+        inf where nothing is checked."""
+        key = tuple(stages)
+        if key in self.compiled:
+            return self.compiled[key]
+
+        compiled = []
+        for rule in self.rules:
+            per_corner = rule["check"] == "position"
+            if rule["check"] == "rotation":
+                shape = (len(stages), 1)
+                dims = [0]
+            else:
+                shape = (len(stages), len(corner_names), len(dim_names)) if per_corner else (len(stages), len(dim_names))
+                dims = [dim_names.index(d) for d in rule["dims"]]
+
+            limit = np.full(shape, np.inf)
+            for s, stage in enumerate(stages):
+                if "stages" in rule and stage not in rule["stages"]:
+                    continue
+                stage_limit = rule.get("stage_limits", {}).get(stage, rule["limit"])
+                if per_corner:
+                    for c, corner in enumerate(corner_names):
+                        if "corners" in rule and corner not in rule["corners"]:
+                            continue
+                        corner_limit = rule.get("corner_limits", {}).get(corner)
+                        if corner_limit is not None and stage in rule.get("stage_limits", {}):
+                            corner_limit = min(corner_limit, stage_limit)
+                        limit[s, c, dims] = stage_limit if corner_limit is None else corner_limit
+                else:
+                    limit[s, dims] = stage_limit
+            compiled.append((rule, limit))
+
+        self.compiled[key] = compiled
+        return compiled
+
+    def ReferenceIndex(self, stages):
+        if self.reference is None:
+            return 0
+        if self.reference not in stages:
+            raise ValueError("Reference stage %s not surveyed" % self.reference)
+        return list(stages).index(self.reference)
+
+    def Values(self, rule, coords, ref):
+        "What a rule checks, for (..., stage, corner, xyz) coordinates"
+        if rule["check"] == "position":
+            return 1000 * (coords - coords[..., ref : ref + 1, :, :])
+
+        centre = coords.mean(axis = -2)
+        if rule["check"] == "offset":
+            return 1000 * (centre - centre[..., ref : ref + 1, :])
+
+        # Rotation of the corners around their centre, compared with the
+        # reference stage, least squares in XY
+        p = coords[..., ref : ref + 1, :, 0:2] - centre[..., ref : ref + 1, None, 0:2]
+        q = coords[..., :, :, 0:2] - centre[..., :, None, 0:2]
+        cross = (p[..., 0] * q[..., 1] - p[..., 1] * q[..., 0]).sum(axis = -1)
+        dot = (p[..., 0] * q[..., 0] + p[..., 1] * q[..., 1]).sum(axis = -1)
+        return 1e6 * np.arctan2(cross, dot)[..., None]
+
+    def Evaluate(self, coords, stages):
+        """Check (stage, corner, xyz) coordinates, or a stack of them
+        (module, stage, corner, xyz) sharing the same stages
+
+        Returns the pass flag (per module for a stack) and a list of
+        failure records, ordered by rule, dim, corner, stage."""
+        coords = np.asarray(coords, dtype = float)
+        batch = coords.ndim == 4
+        if not batch:
+            coords = coords[None]
+        ref = self.ReferenceIndex(stages)
+        last = LastSurveys(stages)
+        if last is not None:
+            coords = coords[:, last]
+
+        passed = np.ones(coords.shape[0], dtype = bool)
+        failures = []
+        for rule, limit in self.Compile(stages):
+            values = self.Values(rule, coords, ref)
+            outside = np.abs(values) >= limit
+            passed &= ~outside.reshape(outside.shape[0], -1).any(axis = 1)
+
+            if rule["check"] == "position":
+                # (module, dim, corner, stage)
+                order = outside.transpose(0, 3, 2, 1)
+                for m, xyz, c, s in np.argwhere(order):
+                    failures.append(FailureRecord(rule, m, stages[s], corner_names[c],
+                                                  dim_names[xyz], values[m, s, c, xyz], limit[s, c, xyz]))
+            else:
+                order = outside.transpose(0, 2, 1)
+                for m, xyz, s in np.argwhere(order):
+                    dim = None if rule["check"] == "rotation" else dim_names[xyz]
+                    failures.append(FailureRecord(rule, m, stages[s], None, dim,
+                                                  values[m, s, xyz], limit[s, xyz]))
+
+        if not batch:
+            for f in failures:
+                del f["module"]
+            return bool(passed[0]), failures
+        return passed, failures
+
+def LastSurveys(stages):
+    """For a stage surveyed more than once, each survey is checked with
+    the values of the last one (as the old results dict did): the index
+    of the last survey of each stage, None if there are no repeats"""
+    last = {}
+    for ind, stage in enumerate(stages):
+        last[stage] = ind
+    if len(last) == len(stages):
+        return None
+    return np.array([last[stage] for stage in stages])
+
+def FailureRecord(rule, module, stage, corner, dim, value, limit):
+    record = collections.OrderedDict()
+    record["rule"] = rule["name"]
+    record["check"] = rule["check"]
+    record["module"] = int(module)
+    record["stage"] = stage
+    record["corner"] = corner
+    record["dim"] = dim
+    record["value"] = float(value)
+    record["limit"] = float(limit)
+    return record
+
+def FormatFailure(f):
+    "Failure record as the strings in TheSurveys.failures"
+    if f["check"] == "position":
+        return f["corner"] + ' - ' + f["stage"] + ': delta' + f["dim"] + ' = ' + str(f["value"]) + ' um'
+    if f["check"] == "offset":
+        return 'offset - ' + f["stage"] + ': delta' + f["dim"] + ' = ' + str(f["value"]) + ' um'
+    return 'rotation - ' + f["stage"] + ': ' + str(f["value"]) + ' urad'
+
+def EvaluateArchive(archive, rules):
+    """Check every survey of a SurveyArchive, stacking those with the
+    same stages; returns per-module pass flags, failure records and
+    whether each was evaluated at all (not if the reference stage
+    wasn't surveyed, those don't pass)"""
+    records = archive.modules
+    passed = np.zeros(len(records), dtype = bool)
+    evaluated = np.zeros(len(records), dtype = bool)
+    failures = []
+
+    groups = collections.OrderedDict()
+    for ind in range(len(records)):
+        groups.setdefault(tuple(archive.Stages(ind)), []).append(ind)
+
+    for stages, inds in groups.items():
+        inds = np.array(inds)
+        try:
+            rules.ReferenceIndex(stages)
+        except ValueError:
+            # Reference stage not surveyed, nothing to compare
+            continue
+        rows = records["first_row"][inds][:, None] + np.arange(len(stages))
+        group_passed, group_failures = rules.Evaluate(archive.coords[rows], list(stages))
+        passed[inds] = group_passed
+        evaluated[inds] = True
+        for f in group_failures:
+            f["module"] = int(inds[f["module"]])
+            failures.append(f)
+
+    return passed, failures, evaluated
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'check archived surveys against a rule set')
+
+    parser.add_argument('rules', help = 'json file with the rule set')
+    parser.add_argument('--archive', dest = 'archive', type = str, default = 'survey_archive',
+                        help = 'SurveyArchive directory')
+    parser.add_argument('--output', '-o', dest = 'output', type = str, default = None,
+                        help = 'write failure records to this json file')
+
+    args = parser.parse_args()
+
+    import SurveyArchive
+    archive = SurveyArchive.SurveyArchive(args.archive)
+    rules = RuleSet.Load(args.rules)
+    passed, failures, evaluated = EvaluateArchive(archive, rules)
+
+    staves = archive.index["staves"]
+    for f in failures:
+        r = archive.modules[f["module"]]
+        f["stave"] = staves[r["stave"]]
+        f["module"] = int(r["module"])
+
+    print("%i of %i surveys pass" % (passed.sum(), evaluated.sum()))
+    if not evaluated.all():
+        print("%i surveys not evaluated, no %s stage"
+              % (len(evaluated) - evaluated.sum(), rules.reference))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(failures, f, indent = 1)
+    else:
+        for f in failures:
+            print("%s module %i: %s" % (f["stave"], f["module"], FormatFailure(f)))
@@ -0,0 +1,186 @@
+#!/bin/env python3
+import argparse
+import collections
+import csv
+import json
+import os, sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import ReadSurvey as RS
+import BatchSurvey
+import SurveyArchive
+import SurveyRules
+
+# Distribution of the placement deltas over many modules and staves:
+# for each stage, corner and X/Y, the mean, sigma, percentiles and the
+# modules far from the rest.
+
+dims = ['X', 'Y']
+percentiles = [5, 25, 50, 75, 95]
+
+def ParseRecord(stave, module, path):
+    survey = SurveyArchive.ParseSurvey(stave, module, path)
+    if survey is None:
+        return None
+    return RS.SurveyRecord.FromSurvey(survey)
+
+def RecordsFromStaves(stave_paths, jobs = None):
+    "(stave, module, SurveyRecord) for every readable survey under the staves"
+    surveys = BatchSurvey.FindSurveys(stave_paths)
+    if len(surveys) == 0:
+        return []
+    pool = ProcessPoolExecutor(max_workers = jobs)
+    try:
+        records = list(pool.map(ParseRecord, *zip(*surveys), chunksize = 16))
+    finally:
+        pool.shutdown()
+    return [(os.path.basename(os.path.normpath(stave)), module, r)
+            for (stave, module, path), r in zip(surveys, records)
+            if r is not None]
+
+def StageDeltas(records, reference = None):
+    """Movement in um from the reference stage (default: the first)
+    {stage: (labels, (module, corner, X/Y) array)}
+
+    A stage surveyed more than once counts once per module, with its
+    last survey (as in SurveyRules)"""
+    labels = collections.OrderedDict()
+    deltas = collections.OrderedDict()
+    for stave, module, record in records:
+        stages = record.stages
+        if reference is None:
+            ref = 0
+        elif reference in stages:
+            ref = stages.index(reference)
+        else:
+            continue
+        last = SurveyRules.LastSurveys(stages)
+        if last is None:
+            last = np.arange(len(stages))
+        d = record.Deltas(last[ref])[:, :, 0 : len(dims)]
+        for ind, stage in enumerate(stages):
+            if stage == stages[ref] or last[ind] != ind:
+                continue
+            labels.setdefault(stage, []).append((stave, module))
+            deltas.setdefault(stage, []).append(d[ind])
+
+    return collections.OrderedDict((stage, (labels[stage], np.array(deltas[stage])))
+                                   for stage in labels)
+
+def ArchiveDeltas(archive, reference):
+    "StageDeltas from a SurveyArchive"
+    result = collections.OrderedDict()
+    for stage in archive.index["stages"]:
+        if stage == reference:
+            continue
+        records, d = archive.Deltas(stage, reference)
+        if len(records) == 0:
+            continue
+        labels = [(archive.index["staves"][s], int(m))
+                  for s, m in zip(archive.modules["stave"][records], archive.modules["module"][records])]
+        result[stage] = (labels, np.asarray(d)[:, :, 0 : len(dims)])
+    return result
+
+def Summarise(labels, deltas, outlier_sigma = 5., tolerance = 25.):
+    """Statistics of (module, corner, X/Y) deltas of one stage
+
+    Outliers are more than outlier_sigma robust sigmas (1.4826 MAD)
+    from the median, or at least tolerance um from the reference."""
+    n = deltas.shape[0]
+    mean = deltas.mean(axis = 0)
+    sigma = deltas.std(axis = 0, ddof = 1) if n > 1 else np.zeros(deltas.shape[1:])
+    pct = np.percentile(deltas, percentiles, axis = 0)
+    median = np.median(deltas, axis = 0)
+    robust = 1.4826 * np.median(np.abs(deltas - median), axis = 0)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        pull = np.abs(deltas - median) / robust
+    # 0/0 where every module has the same delta, a non-zero deviation
+    # from a zero spread is left infinite, and flagged
+    pull[np.isnan(pull)] = 0.
+    outlier = (pull > outlier_sigma) | (np.abs(deltas) >= tolerance)
+
+    summary = collections.OrderedDict()
+    summary["modules"] = n
+    summary["corners"] = collections.OrderedDict()
+    for c, corner in enumerate(RS.corner_names):
+        summary["corners"][corner] = collections.OrderedDict()
+        for xyz, dim in enumerate(dims):
+            s = collections.OrderedDict()
+            s["mean"] = float(mean[c, xyz])
+            s["sigma"] = float(sigma[c, xyz])
+            s["min"] = float(deltas[:, c, xyz].min())
+            s["max"] = float(deltas[:, c, xyz].max())
+            for p, v in zip(percentiles, pct[:, c, xyz]):
+                s["p%d" % p] = float(v)
+            s["outside_tolerance"] = int((np.abs(deltas[:, c, xyz]) >= tolerance).sum())
+            summary["corners"][corner][dim] = s
+
+    summary["outliers"] = []
+    for m, c, xyz in np.argwhere(outlier):
+        stave, module = labels[m]
+        summary["outliers"].append(collections.OrderedDict([
+            ("stave", stave), ("module", module), ("corner", RS.corner_names[c]),
+            ("dim", dims[xyz]), ("delta", float(deltas[m, c, xyz])),
+            ("pull", float(pull[m, c, xyz]))]))
+    return summary
+
+def SummariseAll(stage_deltas, outlier_sigma = 5., tolerance = 25.):
+    return collections.OrderedDict((stage, Summarise(labels, d, outlier_sigma, tolerance))
+                                   for stage, (labels, d) in stage_deltas.items())
+
+def WriteCSV(summaries, fname):
+    with open(fname, "w") as f:
+        writer = csv.writer(f)
+        names = ["mean", "sigma", "min", "max"] + ["p%d" % p for p in percentiles] + ["outside_tolerance"]
+        writer.writerow(["stage", "corner", "dim", "modules"] + names)
+        for stage, summary in summaries.items():
+            for corner, per_dim in summary["corners"].items():
+                for dim, s in per_dim.items():
+                    writer.writerow([stage, corner, dim, summary["modules"]] + [s[n] for n in names])
+
+def PrintSummaries(summaries):
+    for stage, summary in summaries.items():
+        print("%s (%i modules, %i outliers)" % (stage, summary["modules"], len(summary["outliers"])))
+        for corner, per_dim in summary["corners"].items():
+            print("  " + "  ".join("d%s%s = %7.1f +- %5.1f um [%7.1f, %7.1f]"
+                                   % (dim, corner, s["mean"], s["sigma"], s["p5"], s["p95"])
+                                   for dim, s in per_dim.items()))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'statistics of placement deltas over many modules')
+
+    parser.add_argument('stave_paths', nargs = '*', help = 'stave directories containing ModulePlacement/')
+    parser.add_argument('--archive', dest = 'archive', type = str, default = None,
+                        help = 'read surveys from this SurveyArchive instead of parsing')
+    parser.add_argument('--reference', dest = 'reference', type = str, default = None,
+                        help = 'stage to measure movement from (default: first stage, or Ideal for --archive)')
+    parser.add_argument('--outlier-sigma', dest = 'outlier_sigma', type = float, default = 5.,
+                        help = 'flag modules this many robust sigmas from the median')
+    parser.add_argument('--tolerance', dest = 'tolerance', type = float, default = 25.,
+                        help = 'also flag deltas of at least this many um')
+    parser.add_argument('--output', '-o', dest = 'output', type = str, default = 'survey_stats.json',
+                        help = 'output file, .json for everything or .csv for the per-corner table')
+    parser.add_argument('--jobs', '-j', dest = 'jobs', type = int, default = None,
+                        help = 'number of processes parsing surveys')
+
+    args = parser.parse_args()
+
+    if args.archive is not None:
+        stage_deltas = ArchiveDeltas(SurveyArchive.SurveyArchive(args.archive), args.reference or "Ideal")
+    else:
+        if len(args.stave_paths) == 0:
+            print("Need stave directories, or --archive")
+            sys.exit(1)
+        stage_deltas = StageDeltas(RecordsFromStaves(args.stave_paths, args.jobs), args.reference)
+
+    summaries = SummariseAll(stage_deltas, args.outlier_sigma, args.tolerance)
+
+    if args.output.endswith(".csv"):
+        WriteCSV(summaries, args.output)
+    else:
+        with open(args.output, "w") as f:
+            json.dump(summaries, f, indent = 1)
+    PrintSummaries(summaries)
+    print("Written to %s" % args.output)
@@ -1,9 +1,136 @@
 #!/bin/env python
 import os, sys
 import argparse
+import csv
+import glob
+import hashlib
+import re
+import threading
 
 import dbAccess
 
+# Attachments uploaded by this script have the sha256 of their content
+# at the end of the description, so that it can tell which files a
+# component already has
+hash_tag = "[sha256:%s]"
+hash_re = re.compile(r"\[sha256:([0-9a-f]{64})\]")
+
+def file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def read_manifest(fname):
+    """Files to attach, from a csv file with a header row: code and file
+    columns, optionally title, description and file_name (override)"""
+    with open(fname) as f:
+        rows = list(csv.DictReader(f))
+    base = os.path.dirname(os.path.abspath(fname))
+    jobs = []
+    for n, row in enumerate(rows):
+        if not row.get("code") or not row.get("file"):
+            print("Line %d of %s needs code and file" % (n + 2, fname))
+            sys.exit(1)
+        row["file"] = os.path.join(base, row["file"])
+        jobs.append(row)
+    return jobs
+
+def find_files(pattern, code_pattern = None):
+    """Files matching a glob, the component code is the name of the
+    directory each is in, or the 'code' group of code_pattern"""
+    jobs = []
+    for fname in sorted(glob.glob(pattern)):
+        if not os.path.isfile(fname):
+            continue
+        if code_pattern is not None:
+            m = re.search(code_pattern, fname)
+            if m is None:
+                print("No component code in %s, skipping it" % fname)
+                continue
+            code = m.group("code")
+        else:
+            code = os.path.basename(os.path.dirname(os.path.abspath(fname)))
+        jobs.append({"code": code, "file": fname})
+    return jobs
+
+class AttachedHashes(object):
+    "Content hashes of what each component already has, fetched once per component"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.known = {}
+        self.locks = {}
+
+    def claim(self, code, sha):
+        """True if the file isn't attached to the component yet (and
+        isn't being attached by another thread)"""
+        with self.lock:
+            lock = self.locks.setdefault(code, threading.Lock())
+        with lock:
+            if code not in self.known:
+                comp = dbAccess.doSomething("getComponent", {"component": code}, method = "GET")
+                attached = set()
+                for a in (comp or {}).get("attachments") or []:
+                    m = hash_re.search(a.get("description") or "")
+                    if m:
+                        attached.add(m.group(1))
+                self.known[code] = attached
+            if sha in self.known[code]:
+                return False
+            self.known[code].add(sha)
+            return True
+
+    def release(self, code, sha):
+        "The upload failed, so it's not attached after all"
+        with self.locks[code]:
+            self.known[code].discard(sha)
+
+def bulk_upload(jobs, args):
+    import dbBulk
+
+    attached = AttachedHashes()
+
+    items = []
+    for job in jobs:
+        job["sha256"] = file_hash(job["file"])
+        items.append(("%s:%s" % (job["code"], job["sha256"]), job))
+
+    def upload(job):
+        fname = job.get("file_name") or os.path.basename(job["file"])
+        info = {"code": job["code"], "file": job["file"]}
+        if not attached.claim(job["code"], job["sha256"]):
+            info["reason"] = "already attached"
+            return "skipped", info
+
+        description = job.get("description") or args.message or "Attached by add_attachment.py"
+        data = {"component": job["code"],
+                "title": job.get("title") or args.title or fname,
+                "description": "%s %s" % (description, hash_tag % job["sha256"])}
+        try:
+            with open(job["file"], "rb") as f:
+                result = dbAccess.doSomething("createComponentAttachment", data,
+                                              attachments = {"data": (fname, f)})
+        except BaseException:
+            attached.release(job["code"], job["sha256"])
+            raise
+        if not isinstance(result, dict) or "attachment" not in result:
+            attached.release(job["code"], job["sha256"])
+            info["error"] = "Unexpected response: %s" % result
+            return "failed", info
+        info["attachment"] = result["attachment"].get("code")
+        return "ok", info
+
+    log = dbBulk.ProgressLog(args.log)
+    try:
+        results = dbBulk.runBulk(items, upload, args.jobs, log)
+    finally:
+        log.close()
+    return dbBulk.printBulkSummary(results)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Add attachment to component in production database")
     parser.add_argument("--code", help="DB code of component")
@@ -12,9 +139,24 @@ if __name__ == "__main__":
     parser.add_argument("--file", help="File to attach")
     parser.add_argument("--file-name-override", help="Override file-name of attachment")
     parser.add_argument("--test", action="store_true", help="Don't write to DB")
+    parser.add_argument("--progress", action="store_true",
+                        help="Show how much of the file has been sent, and how fast")
     parser.add_argument("--verbose", action="store_true",
                         help="Print what's being sent and received")
 
+    bulk = parser.add_argument_group("bulk upload",
+                                     "Attach many files, skipping any a component already has")
+    bulk.add_argument("--manifest",
+                      help="csv file with code and file columns (and optionally title, description, file_name)")
+    bulk.add_argument("--glob",
+                      help="Attach files matching this pattern, to the component named by their directory")
+    bulk.add_argument("--code-pattern",
+                      help="Regular expression with a (?P<code>...) group taking the code from the path instead")
+    bulk.add_argument("--jobs", "-j", type=int, default=4,
+                      help="Number of files to upload at once")
+    bulk.add_argument("--log", default="add_attachment_log.jsonl",
+                      help="Progress log, files done in an earlier run are not sent again")
+
     args = parser.parse_args()
 
     import dbAccess
@@ -25,6 +167,24 @@ if __name__ == "__main__":
     if os.getenv("ITK_DB_AUTH"):
         dbAccess.token = os.getenv("ITK_DB_AUTH")
 
+    if args.manifest or args.glob:
+        if args.manifest:
+            jobs = read_manifest(args.manifest)
+        else:
+            jobs = find_files(args.glob, args.code_pattern)
+        if len(jobs) == 0:
+            print("No files to attach")
+            sys.exit(1)
+
+        print("Attach %d files to %d components" % (len(jobs), len(set(j["code"] for j in jobs))))
+        if args.test:
+            for job in jobs:
+                print("    %s: %s" % (job["code"], job["file"]))
+            print("Exit early for testing")
+            sys.exit(1)
+
+        sys.exit(1 if bulk_upload(jobs, args) else 0)
+
     if not args.code:
         print("Need code of component, try 'read_db.py list_components'")
         sys.exit(1)
@@ -65,8 +225,12 @@ if __name__ == "__main__":
             attachment = {"data": (args.file_name_override, open(args.file, 'rb'))}
         else:
             attachment = {"data": open(args.file, 'rb')}
+        progress = None
+        if args.progress:
+            progress = dbAccess.dbMultipart.ProgressPrinter(os.path.basename(args.file))
         result = dbAccess.doSomething("createComponentAttachment",
-                                      data, attachments = attachment)
+                                      data, attachments = attachment,
+                                      progress = progress)
         # Responds with...
 
         print(result)
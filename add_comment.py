@@ -1,9 +1,59 @@
 #!/bin/env python
 import os, sys
 import argparse
+import csv
+import hashlib
+import json
 
 import dbAccess
 
+def read_pairs(fname, message = None):
+    """(component code, message) pairs from a csv file with code and
+    message columns, or json lines with code (or component) and message.
+    Without a message column, message is used"""
+    rows = []
+    with open(fname) as f:
+        if fname.endswith(".jsonl") or fname.endswith(".json"):
+            for line in f:
+                if line.strip():
+                    rows.append(json.loads(line))
+        else:
+            rows = list(csv.DictReader(f))
+
+    pairs = []
+    for n, row in enumerate(rows):
+        code = row.get("code") or row.get("component")
+        text = row.get("message") or message
+        if not code or not text:
+            print("Entry %d of %s needs a code and a message" % (n + 1, fname))
+            sys.exit(1)
+        pairs.append((code, text))
+    return pairs
+
+def bulk_comment(pairs, jobs, log_name):
+    "Send each comment, return the number which failed"
+    import dbBulk
+
+    items = []
+    for code, message in pairs:
+        digest = hashlib.sha1(message.encode("utf-8")).hexdigest()[:12]
+        items.append(("%s:%s" % (code, digest), (code, message)))
+
+    def send(item):
+        code, message = item
+        result = dbAccess.doSomething("createComponentComment",
+                                      {"component": code, "comments": [message]})
+        if not isinstance(result, dict) or "component" not in result:
+            return "failed", {"code": code, "error": "Unexpected response: %s" % result}
+        return "ok", {"code": code}
+
+    log = dbBulk.ProgressLog(log_name)
+    try:
+        results = dbBulk.runBulk(items, send, jobs, log)
+    finally:
+        log.close()
+    return dbBulk.printBulkSummary(results)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Add comment to component in production database")
     parser.add_argument("--code", help="DB code of component")
@@ -12,6 +62,21 @@ if __name__ == "__main__":
     parser.add_argument("--test", action="store_true", help="Don't write to DB")
     parser.add_argument("--verbose", action="store_true",
                         help="Print what's being sent and received")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't use cached responses for catalogue requests")
+
+    bulk = parser.add_argument_group("bulk comments",
+                                     "Comment on many components at once")
+    bulk.add_argument("--input",
+                      help="csv (code, message columns) or json lines file of comments to add")
+    bulk.add_argument("--all", action="store_true",
+                      help="Add --message to every component of --component-type (see --filter)")
+    bulk.add_argument("--filter", action="append", default=[], metavar="KEY=VALUE",
+                      help="Only components with this value, eg. currentStage=BARE (with --all)")
+    bulk.add_argument("--jobs", "-j", type=int, default=4,
+                      help="Number of comments to send at once")
+    bulk.add_argument("--log", default="add_comment_log.jsonl",
+                      help="Progress log, comments sent in an earlier run are not sent again")
 
     args = parser.parse_args()
 
@@ -22,9 +87,42 @@ if __name__ == "__main__":
     if args.verbose:
         dbAccess.verbose = True
 
+    if args.no_cache:
+        dbAccess.use_cache = False
+
     if os.getenv("ITK_DB_AUTH"):
         dbAccess.token = os.getenv("ITK_DB_AUTH")
 
+    if args.input or args.all:
+        if args.input:
+            pairs = read_pairs(args.input, args.message)
+        else:
+            if not args.component_type or not args.message:
+                print("Need --component-type and --message to comment on all components")
+                sys.exit(1)
+            data = {"project": "S", "componentType": args.component_type}
+            for f in args.filter:
+                if "=" not in f:
+                    print("Filter should be KEY=VALUE, not %s" % f)
+                    sys.exit(1)
+                k, v = f.split("=", 1)
+                data[k] = v
+            codes = dbAccess.extractList("listComponents", method = "GET",
+                                         data = data, output = "code")
+            pairs = [(c, args.message) for c in codes]
+
+        if len(pairs) == 0:
+            print("No comments to add")
+            sys.exit(1)
+
+        print("Add %d comments to %d components" % (len(pairs), len(set(c for c, m in pairs))))
+        if args.test:
+            for code, message in pairs:
+                print("    %s: %s" % (code, message))
+            sys.exit(1)
+
+        sys.exit(1 if bulk_comment(pairs, args.jobs, args.log) else 0)
+
     if args.code:
         print("Have code to refer to component %s" % args.code)
         if args.component_type:
@@ -23,12 +23,388 @@ testing = False
 if os.getenv("TEST_OVERRIDE"):
     testing = True
 
+# Where to send requests, eg. mockDB.py for offline testing
+db_url = os.getenv("ITK_DB_URL",
+                   "https://uuappg01.plus4u.net/cern-itkpd-test/"
+                   "98234766872260181-dcb3f6d1f130482581ba1e7bbe34413c/")
+auth_url = os.getenv("ITK_DB_AUTH_URL",
+                     "https://oidc.plus4u.net/uu-oidcg01-main/0-0/")
+
+# Requests to the DB reuse pooled keep-alive connections instead of a
+# new TCP+TLS handshake each time, see dbAsync. Connections kept per
+# host (and requests at once) of the module functions
+pool_size = 10
+keep_alive = True
+# (connect, read) timeout in seconds, None to wait forever
+timeout = (10, 120)
+
+# Per-host request and connection counts, filled in by dbAsync
+connection_stats = {}
+
+# Responses to read-only catalogue requests are cached, see dbCache
+import dbCache
+use_cache = True
+if os.getenv("ITK_DB_NO_CACHE"):
+    use_cache = False
+responseCache = None
+
+# Per-request timings and sizes, see dbTrace and setupTracing
+import dbTrace
+
+# Attachments are streamed from their files rather than read into memory
+import dbMultipart
+
+# Large lists can be parsed from the socket an entry at a time (stream
+# option of iterList and friends), see dbStream
+import dbStream
+
+# Requests are made by the asyncio client, which Client wraps
+import dbAsync
+
+# Limit on concurrent requests, when sending several queries at once
+max_workers = 8
+
+# Retry of transient failures, with exponential backoff (in seconds)
+max_retries = 4
+backoff_base = 0.5
+backoff_max = 30
+retry_after_max = 300
+retry_statuses = [429, 502, 503, 504]
+# Statuses meaning the request was not acted on, so always safe to resend
+not_processed_statuses = [429, 503]
+# POST actions which are safe to repeat, as well as any list* or get*
+# query (which are sent as POST when they have data)
+idempotent_actions = ["grantToken"]
+
+# Counters per (action, attempt number), see printRetryStats
+import threading
+attempt_lock = threading.Lock()
+attempt_stats = {}
+
+def setupSession(pool_size = None, keep_alive = None, timeout = None):
+    """Change the connection settings of the module functions, dropping
+    the connections pooled so far"""
+    g = globals()
+    for k, v in [("pool_size", pool_size), ("keep_alive", keep_alive),
+                 ("timeout", timeout)]:
+        if v is not None:
+            g[k] = v
+
+    defaultClient.aio.reset()
+
+def connectionStats():
+    "Requests, new connections and reused connections, per host"
+    result = {}
+    for host, c in connection_stats.items():
+        reused = max(c["requests"] - c["connections"], 0)
+        result[host] = dict(c, reused = reused)
+    return result
+
+def printConnectionStats():
+    print(" ==== Connections =====")
+    for host, c in sorted(connectionStats().items()):
+        print("%s: %d requests, %d connections, %d reused"
+              % (host, c["requests"], c["connections"], c["reused"]))
+
+def setupTracing(log = None, summary = False, histogram = False):
+    """Start tracing requests, to a json lines file log, a summary
+    printed at exit and/or a histogram sink (which is returned)"""
+    sink = None
+    if log is not None:
+        dbTrace.addSink(dbTrace.JsonLinesSink(log))
+    if summary:
+        sink = dbTrace.addSink(dbTrace.SummarySink())
+    if histogram:
+        sink = dbTrace.addSink(dbTrace.HistogramSink())
+    return sink
+
+if os.getenv("ITK_DB_TRACE") or os.getenv("ITK_DB_TRACE_SUMMARY"):
+    setupTracing(os.getenv("ITK_DB_TRACE") or None,
+                 summary = bool(os.getenv("ITK_DB_TRACE_SUMMARY")))
+
 def setupConnection():
-    global token
+    defaultClient.setupConnection()
+
+class TokenExpired(Exception):
+    "The DB rejected the token, a new one is needed"
+    pass
+
+def tokenExpiry(t):
+    "Expiry time (unix seconds) of an id_token, None if not known"
+    import base64
+    try:
+        payload = t.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode("ascii")).decode("utf-8"))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+def defaultTokenFile():
+    return os.getenv("ITK_DB_TOKEN_FILE") or os.path.join(os.path.expanduser("~"), ".itk_db_token")
+
+class TokenManager(object):
+    """Keep the token of a client valid without prompting mid-run
+
+    The token is cached on disk (readable only by the user), so later
+    invocations can reuse it until it expires. A token due to expire
+    within refresh_margin seconds is replaced before being used, and
+    concurrent callers share a single refresh.
+
+    The file records the auth_url and identity of the client the token
+    was granted to, and a token for anyone else isn't used. fname ""
+    keeps the token in memory only.
+
+    Credentials for unattended refresh are those of the client, by
+    default the ITK_DB_ACCESS_CODE1 and ITK_DB_ACCESS_CODE2 environment
+    variables, otherwise authenticate() asks for them.
+    """
+    def __init__(self, fname = None, refresh_margin = 300, client = None):
+        if fname is None:
+            fname = defaultTokenFile()
+        self.fname = fname
+        self.refresh_margin = refresh_margin
+        self.client = client
+
+    def expiring(self, t):
+        expiry = tokenExpiry(t)
+        if expiry is None:
+            # Can't tell, wait to be told by the DB
+            return False
+        import time
+        return expiry - time.time() < self.refresh_margin
+
+    def load(self):
+        if not self.fname:
+            return None
+        try:
+            with open(self.fname) as f:
+                saved = json.load(f)
+            t = saved["id_token"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        # Only a token from the same place, for the same credentials
+        # (when they're known, otherwise whoever logged in last)
+        if saved.get("auth_url", self.client.auth_url) != self.client.auth_url:
+            return None
+        identity = self.client.identity()
+        if identity is not None and saved.get("identity") != identity:
+            return None
+        return t
+
+    def save(self, t):
+        if not self.fname:
+            return
+        try:
+            fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.chmod(self.fname, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"id_token": t, "expires": tokenExpiry(t),
+                           "auth_url": self.client.auth_url,
+                           "identity": self.client.identity()}, f)
+        except (IOError, OSError) as e:
+            print("Failed to save token to %s: %s" % (self.fname, e))
+
+    def clear(self):
+        if not self.fname:
+            return
+        try:
+            os.remove(self.fname)
+        except OSError:
+            pass
+
+    def check(self):
+        "Refresh the token ahead of time if it's about to expire"
+        dbAsync.runSync(self.client.aio.checkToken())
+
+    def refresh(self, stale):
+        """Replace the token stale (None if there isn't one yet)
+
+        If another thread already replaced it while waiting, use that."""
+        return dbAsync.runSync(self.client.aio.refreshToken(stale))
+
+class Client(object):
+    """Connection to the DB with its own token, connections and settings
+
+    The module functions (doSomething, extractList...) use defaultClient,
+    whose state is kept in the module variables scripts set (token,
+    verbose, testing, db_url, auth_url, pool_size and keep_alive). Other
+    clients can be used alongside it, eg. for another account or DB
+    instance, each safe to share between threads.
+
+    Requests are made by aio, its dbAsync.AsyncClient, and each method
+    here waits for the coroutine of the same name, run on the dbAsync
+    background loop. From asyncio, use aio directly.
+
+    The token is cached in a file of its own for each auth_url and set
+    of access codes (unless token_file is given), and only in memory if
+    the access codes aren't known until asked for.
+
+    Retry, cache and trace settings are shared by all clients.
+    """
+    def __init__(self, db_url = None, auth_url = None, token = None,
+                 accessCode1 = None, accessCode2 = None, token_file = None,
+                 pool_size = None, verbose = False, testing = False):
+        self.db_url = db_url or defaultClient.db_url
+        self.auth_url = auth_url or defaultClient.auth_url
+        self.token = token
+        self.accessCode1 = accessCode1
+        self.accessCode2 = accessCode2
+        self.verbose = verbose
+        self.testing = testing
+        self.pool_size = pool_size or defaultClient.pool_size
+        self.keep_alive = defaultClient.keep_alive
+        if token_file is None:
+            identity = self.identity()
+            token_file = "%s.%s" % (defaultTokenFile(), identity[:16]) if identity else ""
+        self.tokenManager = TokenManager(token_file, client = self)
+        self._aio = None
+
+    @property
+    def aio(self):
+        "The dbAsync.AsyncClient making the requests, with this client's token"
+        if self._aio is None:
+            self._aio = dbAsync.AsyncClient(self)
+        return self._aio
+
+    def accessCodes(self):
+        "Credentials for unattended refresh, by default from the environment"
+        return (self.accessCode1 or os.getenv("ITK_DB_ACCESS_CODE1"),
+                self.accessCode2 or os.getenv("ITK_DB_ACCESS_CODE2"))
+
+    def identity(self):
+        """Hash of the auth_url and access codes a token is granted for,
+        None if the codes aren't known (authenticate asks for them)"""
+        import hashlib
+        code1, code2 = self.accessCodes()
+        if code1 is None or code2 is None:
+            return None
+        return hashlib.sha256(("%s\n%s\n%s" % (self.auth_url, code1, code2)).encode("utf-8")).hexdigest()
+
+    def close(self):
+        if self._aio is not None:
+            dbAsync.runSync(self._aio.close())
+
+    def setupConnection(self):
+        dbAsync.runSync(self.aio.setupConnection())
+
+    def authenticate(self, accessCode1 = None, accessCode2 = None):
+        return dbAsync.runSync(self.aio.authenticate(accessCode1, accessCode2))
+
+    def doMultiSomething(self, url, paramdata = None, method = None,
+                         headers = None,
+                         attachments = None, progress = None):
+        """Send paramdata and the attachments as multipart/form-data, read
+        from the files while sending. progress(sent, total) is called as
+        the body goes out, see dbMultipart.ProgressPrinter"""
+        return dbAsync.runSync(self.aio.doMultiSomething(url, paramdata, method = method,
+                                                         headers = headers,
+                                                         attachments = attachments,
+                                                         progress = progress))
+
+    def sendWithRetry(self, method, url, data = None, headers = None, stream = False):
+        "Send a request, retrying failures, see dbAsync.AsyncClient.sendWithRetry"
+        return dbAsync.runSync(self.aio.sendWithRetry(method, url, data = data,
+                                                      headers = headers, stream = stream))
+
+    def doRequest(self, url, data = None, headers = None, method = None, stream = False):
+        return dbAsync.runSync(self.aio.doRequest(url, data = data, headers = headers,
+                                                  method = method, stream = stream))
+
+    def doSomething(self, action, data = None, url = None, method = None,
+                    attachments = None, progress = None, stream = False):
+        """Send action to the DB, returning the decoded response
+
+        With stream, a successful response is returned as a
+        dbStream.StreamedResponse, to be read an item at a time"""
+        return dbAsync.runSync(self.aio.doSomething(action, data, url = url, method = method,
+                                                    attachments = attachments,
+                                                    progress = progress, stream = stream))
+
+    def iterPages(self, action, data = None, url = None, method = None,
+                  prefetch = False, stream = False):
+        """Generate the decoded response for each page of a list action
+
+        Later pages are only requested once the previous one has been used,
+        unless prefetch is set, then the next page is fetched in the
+        background while the current one is being processed.
+
+        With stream, each page is a dbStream.StreamedResponse (unless it
+        came from the cache), its items to be read with listItems before
+        moving on to the next page. This doesn't prefetch, as the page
+        is still arriving while it's used.
+        """
+        return dbAsync.iterSync(self.aio.iterPages(action, data, url = url, method = method,
+                                                   prefetch = prefetch and not stream,
+                                                   stream = stream))
+
+    def iterList(self, action, data = None, url = None, method = None,
+                 output = None, prefetch = False, stream = False):
+        """Generate each item of a list of things, following the pages
+
+        With stream, items are parsed from the response as it arrives
+        (and cut down to output straight away), rather than all at once,
+        which keeps memory low for long lists of large items."""
+        for j in self.iterPages(action, data, url = url, method = method,
+                                prefetch = prefetch, stream = stream):
+            l = listItems(j)
+            if l is None:
+                print(j)
+                return
 
-    print("Setup connection")
+            for i in l:
+                yield outputItem(i, output)
+
+            if isinstance(j, dbStream.StreamedResponse) and j.list_key is None:
+                # Not a list after all
+                print(j.meta)
+                return
 
-    token = authenticate()
+    def extractList(self, action, data = None, url = None, method = None,
+                    output = None, prefetch = False, stream = False):
+        "Extract data for a list of things (as json)"
+        if stream:
+            # Parsed here as it arrives, not on the loop
+            return list(self.iterList(action, data, url = url, method = method,
+                                      output = output, stream = True))
+        return dbAsync.runSync(self.aio.extractList(action, data, url = url, method = method,
+                                                    output = output, prefetch = prefetch))
+
+    def ensureToken(self):
+        "Authenticate now if needed, rather than separately in each worker"
+        dbAsync.runSync(self.aio.ensureToken())
+
+def moduleVariable(name):
+    "Property reading and setting the module variable name"
+    def get(self):
+        return globals()[name]
+    def put(self, value):
+        globals()[name] = value
+    return property(get, put)
+
+class ModuleClient(Client):
+    "The client of the module functions, its state is in the module variables"
+    token = moduleVariable("token")
+    verbose = moduleVariable("verbose")
+    testing = moduleVariable("testing")
+    db_url = moduleVariable("db_url")
+    auth_url = moduleVariable("auth_url")
+    pool_size = moduleVariable("pool_size")
+    keep_alive = moduleVariable("keep_alive")
+
+    def __init__(self):
+        self.accessCode1 = None
+        self.accessCode2 = None
+        self.tokenManager = TokenManager(client = self)
+        self._aio = None
+
+    def close(self):
+        # The module connections stay, setupSession replaces them
+        pass
+
+defaultClient = ModuleClient()
+tokenManager = defaultClient.tokenManager
 
 def to_bytes(s):
     try:
@@ -49,6 +425,9 @@ def fix_encoding(s):
 
     if sys.version_info[0] == 2:
         return s.encode(enc, "replace")
+    elif enc.lower() in ["utf-8", "utf8"]:
+        # Nothing to replace
+        return s
     else:
         # Encode string into bytes
         s = s.encode(enc, "replace")
@@ -56,70 +435,120 @@ def fix_encoding(s):
     return s
 
 def authenticate(accessCode1 = None, accessCode2 = None):
-    print("Getting token")
-    # post
-    # Everything is json header
-
-    a = {"grant_type": "password"}
-
-    if accessCode1 is not None and accessCode2 is not None:
-        a["accessCode1"] = accessCode1
-        a["accessCode2"] = accessCode2
-    else:
-        import getpass
-
-        a["accessCode1"] = getpass.getpass("AccessCode1: ")
-        a["accessCode2"] = getpass.getpass("AccessCode2: ")
+    return defaultClient.authenticate(accessCode1, accessCode2)
 
-    a = to_bytes(json.dumps(a))
-
-    print("Sending credentials to get a token")
+def listComponentTypes():
+    printGetList("listComponentTypes?project=S",
+                 output = "{name} ({code})")
 
-    result = doSomething("grantToken", a,
-                         url = "https://oidc.plus4u.net/uu-oidcg01-main/0-0/")
+def doMultiSomething(*args, **kw):
+    "See Client.doMultiSomething"
+    return defaultClient.doMultiSomething(*args, **kw)
 
-    # print("Authenticate result:", result)
+class AlreadyApplied(Exception):
+    "A POST that failed ambiguously turned out to have been applied"
+    def __init__(self, result):
+        Exception.__init__(self, "Request already applied")
+        self.result = result
 
-    j = to_bytes(result)
-    id_token = j["id_token"]
+def actionName(url):
+    "Name of the DB action from the URL of a request"
+    return url.split("?")[0].rstrip("/").split("/")[-1]
 
-    return id_token
+def retryAfter(r):
+    "Delay in seconds asked for by a Retry-After header, None if none"
+    if r is None or "Retry-After" not in r.headers:
+        return None
+    value = r.headers["Retry-After"]
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    import email.utils
+    import time
+    try:
+        return max(email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time(), 0)
+    except (TypeError, ValueError, OverflowError):
+        return None
 
-def listComponentTypes():
-    printGetList("listComponentTypes?project=S",
-                 output = "{name} ({code})")
+def backoffDelay(attempt, r = None):
+    import random
+    delay = retryAfter(r)
+    if delay is not None:
+        return min(delay, retry_after_max)
+    # Full jitter, so parallel uploads don't retry in lockstep
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+def recordAttempt(action, attempt, elapsed, status):
+    with attempt_lock:
+        c = attempt_stats.setdefault((action, attempt), {"count": 0, "total": 0.0,
+                                                         "max": 0.0, "statuses": {}})
+        c["count"] += 1
+        c["total"] += elapsed
+        c["max"] = max(c["max"], elapsed)
+        c["statuses"][status] = c["statuses"].get(status, 0) + 1
+
+def printRetryStats():
+    print(" ==== Request attempts =====")
+    for (action, attempt), c in sorted(attempt_stats.items()):
+        statuses = ", ".join("%s: %d" % (k, v) for k, v in sorted(c["statuses"].items(), key = str))
+        print("%s attempt %d: %d requests, mean %.3fs, max %.3fs (%s)"
+              % (action, attempt + 1, c["count"], c["total"] / c["count"],
+                 c["max"], statuses))
+
+def fieldValues(fields):
+    "Test run results or properties as a dict of code to value"
+    if isinstance(fields, dict):
+        return fields
+    return dict((f.get("code"), f.get("value")) for f in fields or [])
+
+def testRunRecorded(data, client = None):
+    """Whether the test run in an uploadTestRunResults request is already in the DB
+
+    Runs of the same test type, run number and date are fetched in full,
+    and only count if their results, properties and passed flag are also
+    the same as those uploaded"""
+    if client is None:
+        client = defaultClient
+    comp = client.doSomething("getComponent", {"component": data["component"]},
+                              method = "GET")
+    if not isinstance(comp, dict):
+        return None
 
-def doMultiSomething(url, paramdata = None, method = None,
-                     headers = None,
-                     attachments = None):
+    date = data.get("date", "")
+    if "." in date:
+        # dd.mm.yyyy as uploaded, DB gives yyyy-mm-dd...
+        date = "-".join(reversed(date.split(".")))
 
-    if verbose:
-        print("Multi-part request to %s" % url)
-        print("Send data: %s" % paramdata)
-        print("Send headers: %s" % headers)
-        print("method: POST")
-
-    # print paramdata
-    r = requests.post(url, data = paramdata, headers = headers,
-                      files = attachments)
-
-    if r.status_code in [500, 401]:
-        print("Presumed auth failure")
-        print(r.json())
-        return None
+    for t in comp.get("tests") or []:
+        if t.get("code") != data.get("testType"):
+            continue
+        for run in t.get("testRuns") or []:
+            if run.get("runNumber") != data.get("runNumber"):
+                continue
+            if date and not str(run.get("date", "")).startswith(date):
+                continue
+            full = client.doSomething("getTestRun", {"testRun": run.get("id")},
+                                      method = "GET")
+            if not isinstance(full, dict):
+                continue
+            if full.get("passed") != data.get("passed"):
+                continue
+            if fieldValues(full.get("results")) != fieldValues(data.get("results")):
+                continue
+            if fieldValues(full.get("properties")) != fieldValues(data.get("properties")):
+                continue
+            return run
+    return None
 
-    if r.status_code != 200:
-        print(r)
-        print(r.status_code)
-        print(r.headers)
-        print(r.text)
-        r.raise_for_status()
+# For POST requests which may have reached the DB before failing, a
+# check(data, client) for whether they took effect (returning what was
+# found, or None)
+idempotency_checks = {"uploadTestRunResults": testRunRecorded}
 
-    try:
-        return r.json()
-    except Exception as e:
-        print("No json? ", e)
-        return r.text
+def sendWithRetry(*args, **kw):
+    "See Client.sendWithRetry"
+    return defaultClient.sendWithRetry(*args, **kw)
 
 # Passed the uuAppErrorMap part of the message response
 def decodeError(message, code):
@@ -171,199 +600,178 @@ def decodeError(message, code):
     if not found:
         print("Unknown message: %s" % message)
 
-def doRequest(url, data = None, headers = None, method = None):
-    if method == "post" or method == "POST" or (method is None and data is not None):
-        method = "POST"
-    else:
-        method = "GET"
+def doRequest(*args, **kw):
+    "See Client.doRequest"
+    return defaultClient.doRequest(*args, **kw)
 
-    if verbose:
-        print("Request to %s" % url)
-        print("Send data %s" % data)
-        print("Send headers %s" % headers)
-        print("method %s" % method)
-
-    if method == "POST":
-        # print("Sending post")
-        r = requests.post(url, data = data,
-                          headers = headers)
-    else:
-        # print("Sending get")
-        r = requests.get(url, data = data,
-                         headers = headers)
-
-    if r.status_code == 401:
-        j = r.json()
-        if "uuAppErrorMap" in j and len(j["uuAppErrorMap"]) > 0:
-            if "uu-oidc/invalidToken" in j["uuAppErrorMap"]:
-                global token
-                print("Auth failure, need a new token!")
-                token = None
-                raise Exception("Auth failure, token out of date")
-
-    if r.status_code != 200:
-        try:
-            message = r.json()["uuAppErrorMap"]
-
-            if verbose:
-                print(r.status_code)
-                print(r.headers)
-                print("errormap: %s" % message)
-            decodeError(message, r.status_code)
-            raise BaseException("Error")
-        except Exception as a:
-            print("Failed to decode error: %s" % a)
-            # print(r)
-            print(r.status_code)
-            print(r.headers)
-            print(r.text)
-            raise BaseException("Bad status code")
-
-    if "content-type" in r.headers:
-        # Expect "application/json; charset=UTF-8"
-        ct = r.headers["content-type"]
-        if ct.split("; ")[0] != "application/json":
-            print("Received unexpected content type: %s" % ct)
-    else:
-        print(r.headers)
+def doSomething(*args, **kw):
+    "See Client.doSomething"
+    return defaultClient.doSomething(*args, **kw)
 
+def rewindAttachments(attachments):
+    "Go back to the start of attached files, so they can be sent again"
+    if attachments is None:
+        return
+    for v in attachments.values():
+        if isinstance(v, tuple):
+            v = v[1]
+        if hasattr(v, "seek"):
+            v.seek(0)
+
+def getCache():
+    global responseCache
+    if responseCache is None:
+        responseCache = dbCache.ResponseCache()
+    return responseCache
+
+def invalidateCache(action = None):
+    "Forget cached responses, for all actions or just the one given"
+    getCache().invalidate(action)
+
+def decodeResponse(data):
+    "Response as json, None if it can't be decoded"
     try:
-        return r.json()
-    except Exception as e:
-        print("No json? ", e)
-        return r.text
-
-def doSomething(action, data = None, url = None, method = None,
-                attachments = None):
-    if testing:
-        return doSomethingTesting(action, data, url, method, attachments)
-
-    if token is None and url is None:
-        setupConnection()
-        if token is None:
-            print("Authenticate failed")
-            return
-
-    # baseName = "https://plus4u.net...."
-    if url is None:
-        baseName = "https://uuappg01.plus4u.net/cern-itkpd-test/"
-        baseName += "98234766872260181-dcb3f6d1f130482581ba1e7bbe34413c/"
-    else:
-        baseName = url
+        j = json.loads(data.decode("utf-8"))
+    except ValueError:
+        print("Response not json: %s" % data)
+        return None
+    except AttributeError:
+        # Already decoded to json (by requests)
+        j = data
+    return j
+
+def listItems(j):
+    "The items in one page of a list response, None if not a list"
+    if isinstance(j, dbStream.StreamedResponse):
+        # Generated as they are parsed
+        return j.items()
+    if not isinstance(j, dict):
+        return None
+    if "pageItemList" in j:
+        # Sublist
+        return j["pageItemList"]
+    if "itemList" in j:
+        # Complete list
+        return j["itemList"]
+    return None
+
+def nextPageData(data, pageInfo):
+    "Request data for the page after pageInfo, None if that was the last"
+    try:
+        index = pageInfo["pageIndex"]
+        size = pageInfo["pageSize"]
+        total = pageInfo["total"]
+    except (KeyError, TypeError):
+        return None
 
-    baseName += action
+    if size is None or total is None or (index + 1) * size >= total:
+        return None
 
-    if attachments is not None:
-        # No encoding of data, as this is passed as k,v pairs
-        headers = {"Authorization": "Bearer %s" % token}
-        return doMultiSomething(baseName, paramdata = data,
-                                headers = headers,
-                                method = method, attachments = attachments)
+    if data is None:
+        data = {}
+    elif not isinstance(data, dict):
+        # Already encoded, can't add the page request
+        if verbose:
+            print("Not fetching page %d, data already encoded" % (index + 1))
+        return None
 
-    if data is not None:
-        if type(data) is bytes:
-            reqData = data
-        else:
-            reqData = to_bytes(json.dumps(data))
-        if url is None: # Default
-            pass # print("data is: ", reqData)
-    else:
-        reqData = None
+    data = dict(data)
+    data["pageInfo"] = {"pageIndex": index + 1, "pageSize": size}
+    return data
 
-    headers = {'Content-Type' : 'application/json'}
-    # Header, token
-    if token is not None:
-        headers["Authorization"] = "Bearer %s" % token
+def iterPages(*args, **kw):
+    "See Client.iterPages"
+    return defaultClient.iterPages(*args, **kw)
 
-    result = doRequest(baseName, data = reqData,
-                       headers = headers, method = method)
+def outputItem(i, output):
+    if output is None:
+        # All data
+        return i
+    elif type(output) is list:
+        return list(i[o] for o in output)
+    else:
+        # Just one piece
+        return i[output]
 
-    return result
+def iterList(*args, **kw):
+    "See Client.iterList"
+    return defaultClient.iterList(*args, **kw)
 
 def extractList(*args, **kw):
     "Extract data for a list of things (as json)"
-    output = None
-    if "output" in kw:
-        output = kw["output"]
-        del kw["output"]
+    return defaultClient.extractList(*args, **kw)
+
+def ensureToken():
+    "Authenticate now if needed, rather than separately in each worker"
+    defaultClient.ensureToken()
+
+def doConcurrent(function, args_list, workers = None):
+    """Call function(*args) for each args in args_list on a pool of
+    at most workers threads, return the results in the same order"""
+    if workers is None:
+        workers = max_workers
+    args_list = list(args_list)
+
+    if workers <= 1 or len(args_list) <= 1:
+        return [function(*a) for a in args_list]
 
-    data = doSomething(*args, **kw)
+    ensureToken()
 
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers = min(workers, len(args_list)))
     try:
-        j = json.loads(data.decode("utf-8"))
-    except ValueError:
-        print("Response not json: %s" % data)
-        return
-    except AttributeError:
-        # Already decoded to json (by requests)
-        j = data
-    if "pageItemList" not in j:
-        if "itemList" in j:
-            # Complete list
-            l = j["itemList"]
-        else:
-            print(j)
-            return
-    else:
-        # Sublist
-        l = j["pageItemList"]
+        return list(pool.map(lambda a: function(*a), args_list))
+    finally:
+        pool.shutdown()
 
-    if output is None:
-        # All data
-        return l
-    else:
-        # Just one piece
-        if type(output) is list:
-            result = []
-            for i in l:
-                result.append(list(i[o] for o in output))
-            return result
-        else:
-            return [i[output] for i in l]
+def extractLists(action, data_list, method = None, output = None,
+                 workers = None, stream = False):
+    "extractList for the same action with each of data_list, concurrently"
+    def extract(data):
+        return extractList(action, data, method = method, output = output,
+                           stream = stream)
+
+    return doConcurrent(extract, [(d,) for d in data_list], workers)
 
 def printItem(item, format):
     print(format.format(**item))
 
 def printGetList(*args, **kw):
-    output = None
-    if "output" in kw:
-        output = kw["output"]
-        del kw["output"]
-    data = doSomething(*args, **kw)
+    """Print the items of a list action, with printDict, or
+    format="tree", "table", "jsonl" or "csv" for the faster dbRender"""
+    output = kw.pop("output", None)
+    print_first = kw.pop("print_first", False)
+    prefetch = kw.pop("prefetch", False)
+    format = kw.pop("format", None)
+
+    def items():
+        for j in iterPages(*args, prefetch = prefetch, **kw):
+            l = listItems(j)
+            if l is None:
+                if isinstance(j,list):
+                    print(j)
+                    return
+                else:
+                    l=[j] ##major change here~ So it's gonna go throu printList-->organize things much better
+                         ##because from getcomponent, j is not a list
+
+            if verbose and not isinstance(j, dbStream.StreamedResponse):
+                print(fix_encoding("%s" % l))
 
-    try:
-        j = json.loads(data.decode("utf-8"))
-    except ValueError:
-        print("Response not json: %s" % data)
-        return
-    except AttributeError:
-        # Already decoded to json (by requests)
-        j = data
-    if "pageItemList" not in j:
-        if "itemList" in j:
-            # Complete list
-            l = j["itemList"]
-        else:
-
-            if isinstance(j,list):
-                print(j)
-                return
-            else:
-                l=[j] ##major change here~ So it's gonna go throu printList-->organize things much better
-                     ##because from getcomponent, j is not a list
-    else:
-        # Returned sublist
-        l = j["pageItemList"]
+            for i in l:
+                yield i
 
-    if verbose:
-        print(fix_encoding("%s" % l))
+            if isinstance(j, dbStream.StreamedResponse) and j.list_key is None:
+                yield j.meta
 
-    if output is not None:
-        for i in l:
+    if format is not None:
+        import dbRender
+        dbRender.render(items(), format, columns = output)
+    elif output is not None:
+        for i in items():
             printItem(i, output)
     else:
-
-        printList(l, "print_first" in kw)
+        printList(items(), print_first)
 
 # If output is short enough, can print on one line
 def isShortDict(d):
@@ -457,9 +865,7 @@ def printDict(d, indentation=''):
     for k, v in d.items():
         if v is None:
             print("%s%s: null" % (indentation, k))
-        elif type(v) is str or type(v) is unicode:
-            print("%s%s: %s" % (indentation, k,v))
-        elif type(v) in [bool, int, float]:
+        elif type(v) in simple_type_list:
             print("%s%s: %s" % (indentation, k,v))
         elif type(v) is list:
             print("%s%s (%d)" % (indentation, k, len(v)))
@@ -512,24 +918,24 @@ def summary(project="S"):
     printGetList("listInstitutions", method = "GET", output = inst_output)
 
     print(" ==== Strip component types =====")
-    printGetList("listComponentTypes?project=%s" % project, method = "GET",
-                 output = "{name} ({code})")
+    types = extractList("listComponentTypes", {"project": project}, method = "GET")
+    for t in types:
+        printItem(t, "{name} ({code})")
     # ({subprojects}) ({stages}) ({types})")
 
     # name, code
     #  Arrays: subprojects, stages, types
 
-    type_codes = extractList("listComponentTypes", {"project": project}, method = "GET",
-                             output = "code")
-
     print(" ==== Test types by component =====")
-    type_codes = extractList("listComponentTypes", {"project": project}, method = "GET",
-                             output = "code")
-    for tc in type_codes:
+    type_codes = [t["code"] for t in types]
+    test_types = extractLists("listTestTypes",
+                              [{"project": project, "componentType": tc}
+                               for tc in type_codes],
+                              method = "GET")
+    for tc, l in zip(type_codes, test_types):
         print("Test types for %s" % tc)
-        printGetList("listTestTypes", {"project": project,
-                                       "componentType": tc},
-                     method = "GET", output = "  {name} ({code}) {state}")
+        for i in l:
+            printItem(i, "  {name} ({code}) {state}")
 
 # Produce some response without talking to DB
 def doSomethingTesting(action, data = None, url = None, method = None,
@@ -553,4 +959,4 @@ def doSomethingTesting(action, data = None, url = None, method = None,
         return encode({"pageItemList": [
                 {'code': 'UNIA', 'supervisor': u'First Second With\xe4t\xeda Last', 'name': u'Universit\xe4t A'}, {u'code': u'UNIB', u'supervisor': 'Other Name', 'name': 'University B'}
             ]})
-    raise "Not known"
+    raise Exception("No testing response for %s" % action)
@@ -0,0 +1,945 @@
+#!/bin/env python3
+
+# asyncio client for the DB, for running many operations from one
+# event loop (eg. a lab orchestration service).
+#
+#   async with dbAsync.AsyncClient(concurrency = 32) as db:
+#       comps = await db.extractList("listComponents", {"project": "S"}, method = "GET")
+#       await asyncio.gather(*[db.doSomething("createComponentComment",
+#                                             {"component": c["code"], "comments": ["..."]})
+#                              for c in comps])
+#
+# Requests are written and read with asyncio streams, over keep-alive
+# HTTP/1.1 connections pooled per host, so hundreds can be waiting on
+# the DB from one thread. A semaphore bounds how many are in flight,
+# however many tasks are waiting on them. The token and access codes
+# are those of a dbAccess.Client; retry, cache and trace settings are
+# the dbAccess ones.
+#
+# dbAccess.Client (and so the module functions) is a thin synchronous
+# wrapper over this: each call runs here, on an event loop in a
+# background thread, see runSync.
+
+import asyncio
+import datetime
+import json
+import socket
+import ssl
+import threading
+import time
+import weakref
+
+from urllib.parse import urlsplit
+
+from requests import HTTPError, certs
+from requests.structures import CaseInsensitiveDict
+
+import dbAccess
+import dbCache
+import dbMultipart
+import dbStream
+import dbTrace
+
+chunk_size = 1 << 16
+
+# Made on first https connection, verifying with the same CA bundle as requests
+ssl_context = None
+
+def sslContext():
+    global ssl_context
+    if ssl_context is None:
+        ssl_context = ssl.create_default_context(cafile = certs.where())
+    return ssl_context
+
+class ConnectionFailed(Exception):
+    "The connection failed or timed out before the whole response was read"
+    pass
+
+class ConnectFailed(ConnectionFailed):
+    "No connection could be made, so nothing was sent"
+    pass
+
+# Event loop the synchronous wrappers run on, started on first use
+background_lock = threading.Lock()
+background_loop = None
+
+def backgroundLoop():
+    global background_loop
+    with background_lock:
+        if background_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target = loop.run_forever, name = "dbAsync")
+            thread.daemon = True
+            thread.start()
+            background_loop = loop
+        return background_loop
+
+def runningLoop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def runSync(coro, loop = None):
+    "Run a coroutine on the background loop (or loop), wait for its result"
+    if loop is None:
+        loop = backgroundLoop()
+    if runningLoop() is loop:
+        coro.close()
+        raise RuntimeError("Blocking DB call from its own event loop, use the AsyncClient coroutines")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # Eg. KeyboardInterrupt, don't leave it running
+        future.cancel()
+        raise
+
+def iterSync(agen):
+    "Generate the values of an async generator, each made on the background loop"
+    async def step():
+        try:
+            return True, await agen.__anext__()
+        except StopAsyncIteration:
+            return False, None
+
+    try:
+        while True:
+            more, value = runSync(step())
+            if not more:
+                return
+            yield value
+    finally:
+        runSync(agen.aclose())
+
+def splitTimeout(timeout):
+    "(connect, read) in seconds from dbAccess.timeout"
+    if isinstance(timeout, (tuple, list)):
+        return timeout[0], timeout[1]
+    return timeout, timeout
+
+async def withTimeout(coro, timeout):
+    if timeout is None:
+        return await coro
+    return await asyncio.wait_for(coro, timeout)
+
+class Request(object):
+    "What was sent, for dbTrace"
+    def __init__(self, method, url, headers, body):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+
+class Connection(object):
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+        # LoopState of the pool it goes back to
+        self.state = None
+
+    def usable(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+class Body(object):
+    "Reads the body of a response from its connection, which is then released"
+    def __init__(self, client, connection, version, status, headers, method, timeout):
+        self.client = client
+        self.connection = connection
+        self.timeout = timeout
+        self.done = False
+
+        self.chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        self.chunk_left = 0
+        self.remaining = None
+        if method == "HEAD" or status in [204, 304] or 100 <= status < 200:
+            self.remaining = 0
+        elif not self.chunked and headers.get("Content-Length") is not None:
+            self.remaining = int(headers["Content-Length"])
+
+        # Otherwise the body runs to the end of the connection
+        self.reusable = ((self.chunked or self.remaining is not None)
+                         and version == "HTTP/1.1"
+                         and headers.get("Connection", "").lower() != "close")
+
+    async def read(self, size = chunk_size):
+        "Up to size bytes of the body, b'' at its end"
+        if self.done:
+            return b""
+        try:
+            return await withTimeout(self.readSome(size), self.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            self.close()
+            raise ConnectionFailed("Reading response: %s" % (str(e) or type(e).__name__))
+
+    async def readSome(self, size):
+        reader = self.connection.reader
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await reader.readline()
+                if not line:
+                    raise asyncio.IncompleteReadError(b"", None)
+                n = int(line.split(b";")[0].strip(), 16)
+                if n == 0:
+                    # Trailers, up to a blank line
+                    while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                        pass
+                    self.finish()
+                    return b""
+                self.chunk_left = n
+            data = await reader.read(min(size, self.chunk_left))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", self.chunk_left)
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await reader.readexactly(2)
+            return data
+
+        if self.remaining is not None:
+            if self.remaining == 0:
+                self.finish()
+                return b""
+            data = await reader.read(min(size, self.remaining))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", self.remaining)
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                self.finish()
+            return data
+
+        data = await reader.read(size)
+        if not data:
+            self.finish()
+        return data
+
+    async def readAll(self):
+        chunks = []
+        while True:
+            data = await self.read()
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+    def finish(self):
+        self.done = True
+        if self.reusable:
+            self.client.release(self.connection)
+        else:
+            self.connection.close()
+
+    def close(self):
+        "Stop reading, the connection can't be reused"
+        if not self.done:
+            self.done = True
+            self.connection.close()
+
+class Response(object):
+    """A response, with the parts of requests.Response dbAccess uses
+
+    The body is read before it's returned, unless streamed: then it's
+    read from the connection by iter_content (from another thread than
+    the loop, eg. by a dbStream.StreamedResponse), or dropped by close()"""
+    def __init__(self, request, version, status, reason, headers, loop):
+        self.request = request
+        self.url = request.url
+        self.status_code = status
+        self.reason = reason
+        self.version = version
+        self.headers = CaseInsensitiveDict(headers)
+        self.loop = loop
+        self.body = None
+        self._content = None
+        self.elapsed = datetime.timedelta(0)
+        self.connection_timing = None
+
+    def __repr__(self):
+        return "<Response [%d]>" % self.status_code
+
+    @property
+    def encoding(self):
+        for part in self.headers.get("Content-Type", "").split(";")[1:]:
+            part = part.strip()
+            if part.lower().startswith("charset="):
+                return part[len("charset="):].strip('"')
+        return None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content(chunk_size))
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, size = 1):
+        if self._content is not None:
+            for start in range(0, len(self._content), size):
+                yield self._content[start : start + size]
+            return
+        if self.body is None:
+            return
+        while True:
+            data = runSync(self.body.read(size), self.loop)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.body is not None and not self.body.done:
+            self.loop.call_soon_threadsafe(self.body.close)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError("%d %s for url: %s" % (self.status_code, self.reason, self.url),
+                                     response = self)
+
+class LoopState(object):
+    "Connections and limits of a client in one event loop"
+    def __init__(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.token_lock = asyncio.Lock()
+        # (scheme, host, port) -> idle connections, most recently used last
+        self.idle = {}
+
+class AsyncClient(object):
+    def __init__(self, client = None, concurrency = None, **kw):
+        """client the dbAccess.Client whose token and settings to use,
+        otherwise a new one is made with kw (db_url, token, accessCode1...).
+        concurrency is the number of requests at once, and connections
+        kept per host (default the pool_size of the client)"""
+        if client is None:
+            client = dbAccess.Client(pool_size = concurrency, **kw)
+            client._aio = self
+        self.client = client
+        self._concurrency = concurrency
+        self.loops = weakref.WeakKeyDictionary()
+        # host -> requests and new connections, as dbAccess.connection_stats
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @property
+    def concurrency(self):
+        if self._concurrency is not None:
+            return self._concurrency
+        return self.client.pool_size
+
+    def state(self):
+        "LoopState of the running loop"
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            s = self.loops.get(loop)
+            if s is None:
+                s = self.loops[loop] = LoopState(self.concurrency)
+            return s
+
+    def reset(self):
+        """Drop the idle connections, so settings changed since (pool
+        size, keep_alive) are taken up"""
+        with self.lock:
+            states = list(self.loops.items())
+            self.loops.clear()
+        for loop, s in states:
+            for connections in s.idle.values():
+                for c in connections:
+                    if loop.is_closed():
+                        continue
+                    loop.call_soon_threadsafe(c.close)
+
+    def count(self, key, new):
+        host = "%s://%s" % (key[0], key[1])
+        with self.lock:
+            c = self.counts.setdefault(host, {"requests": 0, "connections": 0})
+            c["requests"] += 1
+            if new:
+                c["connections"] += 1
+            dbAccess.connection_stats[host] = dict(c)
+
+    async def connect(self, key, timeout):
+        """A connection for key, idle one if there is one, and the time to
+        look up the host and connect if it's new"""
+        s = self.state()
+        idle = s.idle.get(key) or []
+        while idle:
+            c = idle.pop()
+            if c.usable():
+                c.state = s
+                return c, None
+            c.close()
+
+        scheme, host, port = key
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        try:
+            infos = await withTimeout(loop.getaddrinfo(host, port, type = socket.SOCK_STREAM), timeout)
+            looked_up = time.time()
+            context = sslContext() if scheme == "https" else None
+            reader, writer = await withTimeout(asyncio.open_connection(
+                infos[0][4][0], port, ssl = context,
+                server_hostname = host if context is not None else None,
+                limit = chunk_size), timeout)
+        except (OSError, asyncio.TimeoutError, IndexError) as e:
+            raise ConnectFailed("Connecting to %s:%s: %s" % (host, port, str(e) or type(e).__name__))
+        timing = {"dns": looked_up - start, "connect": time.time() - looked_up}
+        c = Connection(key, reader, writer)
+        c.state = s
+        return c, timing
+
+    def release(self, c):
+        "Keep a connection for the next request, if there's room"
+        s = getattr(c, "state", None)
+        with self.lock:
+            current = s is not None and any(v is s for v in self.loops.values())
+        idle = s.idle.setdefault(c.key, []) if current else None
+        if (idle is None or not self.client.keep_alive or not c.usable()
+            or len(idle) >= self.concurrency):
+            c.close()
+            return
+        idle.append(c)
+
+    async def write(self, c, method, target, host, headers, data):
+        lines = ["%s %s HTTP/1.1" % (method, target), "Host: %s" % host,
+                 "Accept: */*", "Accept-Encoding: identity"]
+        if not self.client.keep_alive:
+            lines.append("Connection: close")
+        for k, v in (headers or {}).items():
+            lines.append("%s: %s" % (k, v))
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if data is not None or method == "POST":
+            lines.append("Content-Length: %d" % dbTrace.bodySize(data))
+
+        w = c.writer
+        w.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if isinstance(data, bytes):
+            w.write(data)
+        elif data is not None:
+            # Read from the files off the loop
+            loop = asyncio.get_running_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, data.read, chunk_size)
+                if not chunk:
+                    break
+                w.write(chunk)
+                await w.drain()
+        await w.drain()
+
+    async def readHead(self, c):
+        "HTTP version, status, reason and headers of a response"
+        while True:
+            line = await c.reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+            if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+                raise ValueError("Bad status line %r" % line)
+            version, status = parts[0], int(parts[1])
+            reason = parts[2] if len(parts) > 2 else ""
+
+            headers = []
+            while True:
+                line = await c.reader.readline()
+                if line in [b"\r\n", b"\n"]:
+                    break
+                if not line:
+                    raise asyncio.IncompleteReadError(b"", None)
+                k, v = line.decode("latin-1").split(":", 1)
+                headers.append((k.strip(), v.strip()))
+            if status != 100:
+                return version, status, reason, headers
+
+    async def request(self, method, url, data = None, headers = None, stream = False):
+        """Send one request and read its response (only the head, with
+        stream), raising ConnectionFailed if that couldn't be done"""
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        connect_timeout, read_timeout = splitTimeout(dbAccess.timeout)
+        loop = asyncio.get_running_loop()
+
+        async with self.state().semaphore:
+            while True:
+                c, timing = await self.connect(key, connect_timeout)
+                start = time.time()
+                try:
+                    await self.write(c, method, target, parts.netloc, headers, data)
+                    version, status, reason, response_headers = await withTimeout(self.readHead(c),
+                                                                                  read_timeout)
+                    break
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                    c.close()
+                    if (timing is None and isinstance(e, (ConnectionError, asyncio.IncompleteReadError))
+                        and (data is None or isinstance(data, bytes) or hasattr(data, "rewind"))):
+                        # A kept-alive connection the server had already
+                        # closed, start again on a new one
+                        if hasattr(data, "rewind"):
+                            data.rewind()
+                        continue
+                    raise ConnectionFailed("%s %s: %s" % (method, url, str(e) or type(e).__name__))
+
+            c.requests += 1
+            self.count(key, timing is not None)
+
+        r = Response(Request(method, url, headers, data), version, status, reason,
+                     response_headers, loop)
+        r.connection_timing = timing
+        r.elapsed = datetime.timedelta(seconds = time.time() - start + sum((timing or {}).values()))
+        r.body = Body(self, c, version, status, r.headers, method, read_timeout)
+        if not stream:
+            r._content = await r.body.readAll()
+        return r
+
+    async def sendWithRetry(self, method, url, data = None, headers = None, stream = False):
+        """Send a request, retrying connection errors and transient statuses
+
+        GETs, queries and idempotent_actions are always retried. Other POSTs are
+        only resent if the DB can't have acted on them (no connection,
+        429/503), or if their idempotency check shows they didn't reach it.
+        If the check finds they did, dbAccess.AlreadyApplied is raised with
+        the result of the check. With stream, the body is left to be read
+        from the response returned."""
+        action = dbAccess.actionName(url)
+        idempotent = (method == "GET" or action in dbAccess.idempotent_actions
+                      or action.startswith("list") or action.startswith("get"))
+
+        trace = None
+        if dbTrace.enabled():
+            trace = dbTrace.makeTrace(action, method)
+        first = time.time()
+
+        attempt = 0
+        r = None
+        error = None
+        try:
+            while True:
+                r = None
+                error = None
+                start = time.time()
+                try:
+                    r = await self.request(method, url, data = data, headers = headers,
+                                           stream = stream)
+                    status = r.status_code
+                except ConnectionFailed as e:
+                    error = e
+                    status = type(e).__name__
+                dbAccess.recordAttempt(action, attempt, time.time() - start, status)
+
+                if r is not None and r.status_code not in dbAccess.retry_statuses:
+                    return r
+
+                if attempt >= dbAccess.max_retries:
+                    break
+
+                safe = (idempotent
+                        or isinstance(error, ConnectFailed)
+                        or (r is not None and r.status_code in dbAccess.not_processed_statuses))
+
+                if not safe:
+                    check = dbAccess.idempotency_checks.get(action)
+                    if check is None:
+                        break
+                    try:
+                        payload = data
+                        if isinstance(payload, bytes):
+                            payload = payload.decode("utf-8")
+                        if not isinstance(payload, dict):
+                            payload = json.loads(payload)
+                        # Checks make their own (blocking) requests
+                        loop = asyncio.get_running_loop()
+                        found = await loop.run_in_executor(None, check, payload, self.client)
+                    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+                        raise
+                    except BaseException as e:
+                        # doRequest reports DB errors as BaseException
+                        print("Can't tell whether %s was applied: %s" % (action, e))
+                        break
+                    if found:
+                        print("%s was applied despite the error, not resending" % action)
+                        raise dbAccess.AlreadyApplied(found)
+
+                if stream and r is not None:
+                    # Not reading the body, let the connection go
+                    r.body.close()
+
+                delay = dbAccess.backoffDelay(attempt, r)
+                print("%s failed (%s), retrying in %.1fs" % (action, status, delay))
+                await asyncio.sleep(delay)
+                if hasattr(data, "rewind"):
+                    data.rewind()
+                attempt += 1
+
+            if r is not None:
+                return r
+            raise error
+        finally:
+            if trace is not None:
+                trace["retries"] = attempt
+                if r is not None:
+                    dbTrace.fillFromResponse(trace, r, stream)
+                elif error is not None:
+                    trace["status"] = type(error).__name__
+                trace["total"] = time.time() - first
+                dbTrace.emit(trace)
+
+    async def doRequest(self, url, data = None, headers = None, method = None, stream = False):
+        if method == "post" or method == "POST" or (method is None and data is not None):
+            method = "POST"
+        else:
+            method = "GET"
+
+        if self.client.verbose:
+            print("Request to %s" % url)
+            print("Send data %s" % data)
+            print("Send headers %s" % headers)
+            print("method %s" % method)
+
+        try:
+            r = await self.sendWithRetry(method, url, data = data, headers = headers,
+                                         stream = stream)
+        except dbAccess.AlreadyApplied as e:
+            return e.result
+
+        if stream and r.status_code != 200:
+            # Errors are small, read them now
+            r._content = await r.body.readAll()
+
+        if r.status_code == 401:
+            j = r.json()
+            if "uuAppErrorMap" in j and len(j["uuAppErrorMap"]) > 0:
+                if "uu-oidc/invalidToken" in j["uuAppErrorMap"]:
+                    print("Auth failure, need a new token!")
+                    raise dbAccess.TokenExpired("Auth failure, token out of date")
+
+        if r.status_code != 200:
+            try:
+                message = r.json()["uuAppErrorMap"]
+
+                if self.client.verbose:
+                    print(r.status_code)
+                    print(r.headers)
+                    print("errormap: %s" % message)
+                dbAccess.decodeError(message, r.status_code)
+                raise BaseException("Error")
+            except Exception as a:
+                print("Failed to decode error: %s" % a)
+                # print(r)
+                print(r.status_code)
+                print(r.headers)
+                print(r.text)
+                raise BaseException("Bad status code")
+
+        if "content-type" in r.headers:
+            # Expect "application/json; charset=UTF-8"
+            ct = r.headers["content-type"]
+            if ct.split("; ")[0] != "application/json":
+                print("Received unexpected content type: %s" % ct)
+        else:
+            print(r.headers)
+
+        if stream:
+            return dbStream.StreamedResponse(r)
+
+        try:
+            return r.json()
+        except Exception as e:
+            print("No json? ", e)
+            return r.text
+
+    async def doMultiSomething(self, url, paramdata = None, method = None,
+                               headers = None,
+                               attachments = None, progress = None):
+        """Send paramdata and the attachments as multipart/form-data, read
+        from the files while sending. progress(sent, total) is called as
+        the body goes out, see dbMultipart.ProgressPrinter"""
+
+        body = dbMultipart.MultipartEncoder(paramdata, attachments, progress = progress)
+        headers = dict(headers or {})
+        headers["Content-Type"] = body.content_type
+
+        if self.client.verbose:
+            print("Multi-part request to %s" % url)
+            print("Send data: %s" % paramdata)
+            print("Send headers: %s" % headers)
+            print("Send %d bytes" % body.len)
+            print("method: POST")
+
+        try:
+            r = await self.sendWithRetry("POST", url, data = body, headers = headers)
+        except dbAccess.AlreadyApplied as e:
+            return e.result
+
+        if r.status_code == 401:
+            print("Auth failure, need a new token!")
+            raise dbAccess.TokenExpired("Auth failure, token out of date")
+
+        if r.status_code == 500:
+            print("Presumed auth failure")
+            print(r.json())
+            return None
+
+        if r.status_code != 200:
+            print(r)
+            print(r.status_code)
+            print(r.headers)
+            print(r.text)
+            r.raise_for_status()
+
+        try:
+            return r.json()
+        except Exception as e:
+            print("No json? ", e)
+            return r.text
+
+    async def authenticate(self, accessCode1 = None, accessCode2 = None):
+        print("Getting token")
+
+        a = {"grant_type": "password"}
+
+        if accessCode1 is not None and accessCode2 is not None:
+            a["accessCode1"] = accessCode1
+            a["accessCode2"] = accessCode2
+        else:
+            import getpass
+
+            loop = asyncio.get_running_loop()
+            a["accessCode1"] = await loop.run_in_executor(None, getpass.getpass, "AccessCode1: ")
+            a["accessCode2"] = await loop.run_in_executor(None, getpass.getpass, "AccessCode2: ")
+
+        a = dbAccess.to_bytes(json.dumps(a))
+
+        print("Sending credentials to get a token")
+
+        result = await self.doSomething("grantToken", a, url = self.client.auth_url)
+
+        return result["id_token"]
+
+    async def refreshToken(self, stale):
+        """Replace the token stale (None if there isn't one yet), from the
+        token file if it has a newer one, otherwise by authenticating
+
+        If another task already replaced it while waiting, use that."""
+        client = self.client
+        manager = client.tokenManager
+        async with self.state().token_lock:
+            t = client.token
+            if t is not None and t != stale and not manager.expiring(t):
+                return t
+
+            t = manager.load()
+            if t is None or t == stale or manager.expiring(t):
+                t = await self.authenticate(*client.accessCodes())
+                manager.save(t)
+
+            client.token = t
+            return t
+
+    async def checkToken(self):
+        "Refresh the token ahead of time if it's about to expire"
+        t = self.client.token
+        if t is not None and self.client.tokenManager.expiring(t):
+            print("Token about to expire, refreshing")
+            await self.refreshToken(t)
+
+    async def setupConnection(self):
+        print("Setup connection")
+
+        await self.refreshToken(None)
+
+    async def ensureToken(self):
+        "Authenticate (grantToken) now, rather than in the first requests"
+        if self.client.token is None and not self.client.testing:
+            await self.setupConnection()
+        return self.client.token
+
+    async def doSomething(self, action, data = None, url = None, method = None,
+                          attachments = None, progress = None, stream = False):
+        """Send action to the DB, returning the decoded response
+
+        With stream, a successful response is returned as a
+        dbStream.StreamedResponse, to be read an item at a time (from
+        another thread, see Response)"""
+        client = self.client
+        if client.testing:
+            return dbAccess.doSomethingTesting(action, data, url, method, attachments)
+
+        # baseName = "https://plus4u.net...."
+        if url is None:
+            baseName = client.db_url
+        else:
+            baseName = url
+
+        cacheKey = None
+        if dbAccess.use_cache and attachments is None and dbCache.isCacheable(action, data, method):
+            cacheAction, cacheKey = dbAccess.getCache().key(baseName, action, data)
+            result = dbAccess.getCache().get(cacheKey)
+            if result is not None:
+                if client.verbose:
+                    print("Cached response for %s" % action)
+                if dbTrace.enabled():
+                    trace = dbTrace.makeTrace(dbCache.splitAction(action)[0], method or "GET")
+                    trace["cached"] = True
+                    dbTrace.emit(trace)
+                return result
+
+        if url is None:
+            if client.token is None:
+                await self.setupConnection()
+                if client.token is None:
+                    print("Authenticate failed")
+                    return
+            else:
+                await self.checkToken()
+
+        baseName += action
+
+        if data is not None and attachments is None:
+            if type(data) is bytes:
+                reqData = data
+            else:
+                reqData = dbAccess.to_bytes(json.dumps(data))
+        else:
+            reqData = None
+
+        async def send(t):
+            if attachments is not None:
+                # No encoding of data, as this is passed as k,v pairs
+                headers = {"Authorization": "Bearer %s" % t}
+                return await self.doMultiSomething(baseName, paramdata = data,
+                                                   headers = headers,
+                                                   method = method, attachments = attachments,
+                                                   progress = progress)
+
+            headers = {'Content-Type' : 'application/json'}
+            # Header, token
+            if t is not None:
+                headers["Authorization"] = "Bearer %s" % t
+
+            return await self.doRequest(baseName, data = reqData,
+                                        headers = headers, method = method, stream = stream)
+
+        used = client.token
+        try:
+            result = await send(used)
+        except dbAccess.TokenExpired:
+            if url is not None:
+                raise
+            # Once only, with a fresh token
+            await self.refreshToken(used)
+            dbAccess.rewindAttachments(attachments)
+            result = await send(client.token)
+
+        if cacheKey is not None and isinstance(result, (dict, list)):
+            dbAccess.getCache().put(cacheKey, cacheAction, result)
+
+        return result
+
+    async def iterPages(self, action, data = None, url = None, method = None,
+                        prefetch = False, stream = False):
+        """Generate the decoded response for each page of a list action,
+        see dbAccess.Client.iterPages
+
+        With prefetch, the next page is requested while the current one
+        is being used. Streamed pages are read from another thread."""
+        next_page = None
+        try:
+            result = await self.doSomething(action, data, url = url, method = method,
+                                            stream = stream)
+            while True:
+                if isinstance(result, dbStream.StreamedResponse):
+                    yield result
+                    # pageInfo can come after the items, so is only known
+                    # once they've been read (off the loop, see Response)
+                    loop = asyncio.get_running_loop()
+                    meta = await loop.run_in_executor(None, result.finish)
+                    data = dbAccess.nextPageData(data, meta.get("pageInfo"))
+                    if data is None:
+                        return
+                    result = await self.doSomething(action, data, url = url, method = method,
+                                                    stream = stream)
+                    continue
+
+                j = dbAccess.decodeResponse(result)
+                if j is None:
+                    return
+
+                pageInfo = None
+                if isinstance(j, dict):
+                    pageInfo = j.get("pageInfo")
+                data = dbAccess.nextPageData(data, pageInfo)
+
+                if data is not None and prefetch:
+                    next_page = asyncio.ensure_future(self.doSomething(action, data, url = url,
+                                                                       method = method))
+
+                yield j
+
+                if data is None:
+                    return
+
+                if next_page is not None:
+                    result = await next_page
+                    next_page = None
+                else:
+                    result = await self.doSomething(action, data, url = url, method = method)
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iterList(self, action, data = None, url = None, method = None,
+                       output = None, prefetch = False):
+        """Generate each item of a list of things, following the pages
+        (async for), each page is fetched once the last has been used
+        unless prefetch is set"""
+        async for j in self.iterPages(action, data, url = url, method = method,
+                                      prefetch = prefetch):
+            l = dbAccess.listItems(j)
+            if l is None:
+                print(j)
+                return
+            for i in l:
+                yield dbAccess.outputItem(i, output)
+
+    async def extractList(self, action, data = None, url = None, method = None,
+                          output = None, prefetch = False):
+        "All items of a list of things, see dbAccess.extractList"
+        return [i async for i in self.iterList(action, data, url = url, method = method,
+                                               output = output, prefetch = prefetch)]
+
+    async def gather(self, action, data_list, method = None):
+        "doSomething for action with each of data_list, results in the same order"
+        return await asyncio.gather(*[self.doSomething(action, data, method = method)
+                                      for data in data_list])
+
+    async def close(self):
+        "Close the idle connections of the running loop"
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            s = self.loops.pop(loop, None)
+        if s is None:
+            return
+        connections = [c for idle in s.idle.values() for c in idle]
+        for c in connections:
+            c.close()
+        for c in connections:
+            try:
+                await c.writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,122 @@
+#!/bin/env python3
+
+# Running many DB operations concurrently, with a log so that an
+# interrupted run can be restarted without repeating finished items.
+#
+# The log is json lines, one entry per item with its key and status:
+#   {"key": "...", "status": "ok", "time": ..., ...}
+# Items logged as ok or skipped are not run again.
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import dbAccess
+
+done_statuses = ["ok", "skipped"]
+
+class ProgressLog(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by the interruption
+                        continue
+                    self.entries[entry["key"]] = entry
+        except (IOError, OSError):
+            pass
+        self.f = open(fname, "a")
+
+    def isDone(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry["status"] in done_statuses
+
+    def record(self, key, status, **info):
+        entry = OrderedDict([("key", key), ("status", status), ("time", time.time())])
+        entry.update(info)
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            self.entries[key] = entry
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def runBulk(items, function, workers = None, log = None):
+    """Call function(item) for each (key, item) on a pool of threads
+
+    function returns (status, {info}), an exception counts as status
+    "failed". Each result is printed as it finishes and added to the
+    log, items already done in the log are not run. Returns the result
+    for each item, in order, as {"key", "status", ...}."""
+    if workers is None:
+        workers = dbAccess.max_workers
+    items = list(items)
+
+    results = [None] * len(items)
+    todo = []
+    for ind, (key, item) in enumerate(items):
+        if log is not None and log.isDone(key):
+            results[ind] = OrderedDict([("key", key), ("status", "done before")])
+        else:
+            todo.append(ind)
+    if len(todo) < len(items):
+        print("%d of %d already done in %s" % (len(items) - len(todo), len(items), log.fname))
+
+    def run(ind):
+        key, item = items[ind]
+        try:
+            status, info = function(item)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        # dbAccess reports bad status codes with a BaseException
+        except BaseException as e:
+            status, info = "failed", {"error": "%s: %s" % (type(e).__name__, e)}
+        return status, info
+
+    if len(todo) > 0:
+        dbAccess.ensureToken()
+        if workers > dbAccess.pool_size:
+            dbAccess.setupSession(pool_size = workers)
+
+    start = time.time()
+    pool = ThreadPoolExecutor(max_workers = max(1, min(workers, len(todo))))
+    try:
+        futures = dict((pool.submit(run, ind), ind) for ind in todo)
+        for done, future in enumerate(as_completed(futures)):
+            ind = futures[future]
+            key = items[ind][0]
+            status, info = future.result()
+            if log is not None:
+                log.record(key, status, **info)
+            results[ind] = OrderedDict([("key", key), ("status", status)])
+            results[ind].update(info)
+
+            detail = info.get("error") or info.get("reason") or ""
+            print("[%d/%d %.1fs] %s: %s %s" % (done + 1, len(todo), time.time() - start,
+                                               key, status, detail))
+    finally:
+        pool.shutdown()
+
+    return results
+
+def printBulkSummary(results):
+    counts = OrderedDict()
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    print("%d items: %s" % (len(results), ", ".join("%d %s" % (n, s) for s, n in counts.items())))
+
+    failed = [r for r in results if r["status"] not in done_statuses + ["done before"]]
+    for r in failed:
+        print("  %s: %s" % (r["key"], r.get("error", r["status"])))
+    return len(failed)
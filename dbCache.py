@@ -0,0 +1,203 @@
+#!/bin/env python3
+
+# Cache of responses to read-only DB requests (institutions, component
+# and test types), which almost never change.
+#
+# Two tiers: an in-process LRU dict, in front of a directory of json
+# files which survives between invocations. Both are bounded in size
+# and entries expire after ttl seconds.
+#
+# Entries are kept as json text, and decoded afresh for each hit, so a
+# caller changing the response it was given doesn't change the cache.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+# Only GET requests for these actions are cached
+cacheable_actions = ["listInstitutions", "listComponentTypes",
+                     "listTestTypes", "listProjects"]
+
+def defaultDirectory():
+    d = os.getenv("ITK_DB_CACHE_DIR")
+    if d:
+        return d
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "itk_db")
+
+def splitAction(action):
+    "Split 'listThings?a=b' into the action name and a dict of parameters"
+    if "?" not in action:
+        return action, {}
+    name, query = action.split("?", 1)
+    params = {}
+    for p in query.split("&"):
+        if "=" in p:
+            k, v = p.split("=", 1)
+            params[k] = v
+    return name, params
+
+def isCacheable(action, data = None, method = None):
+    if method is not None and method.upper() == "POST":
+        return False
+    if method is None and data is not None:
+        # Will be sent as a POST
+        return False
+    if data is not None and not isinstance(data, dict):
+        return False
+    return splitAction(action)[0] in cacheable_actions
+
+class ResponseCache(object):
+    def __init__(self, directory = None, ttl = 24 * 3600,
+                 max_entries = 128, max_disk_entries = 1024,
+                 max_disk_bytes = 64 * 1024 * 1024):
+        if directory is None:
+            directory = defaultDirectory()
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = max_disk_bytes
+
+        # key -> (time stored, action, response as json), least recently used first
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, url, action, data = None):
+        "Key from the URL, action name, parameters and project"
+        name, params = splitAction(action)
+        if data is not None:
+            params.update(data)
+        project = params.get("project")
+
+        k = json.dumps([url, name, project, params], sort_keys = True)
+        return name, hashlib.sha1(k.encode("utf-8")).hexdigest()
+
+    def fileName(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def get(self, key):
+        "Cached response for key, None if not cached or expired"
+        with self.lock:
+            if key in self.memory:
+                stored, action, text = self.memory[key]
+                if not self.expired(stored):
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(text)
+                del self.memory[key]
+
+            fname = self.fileName(key)
+            try:
+                with open(fname) as f:
+                    entry = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.misses += 1
+                return None
+
+            if self.expired(entry["time"]):
+                self.remove(fname)
+                self.misses += 1
+                return None
+
+            # mtime is the last use, for LRU eviction on disk
+            try:
+                os.utime(fname, None)
+            except OSError:
+                pass
+
+            self.storeMemory(key, entry["time"], entry["action"], json.dumps(entry["data"]))
+            self.disk_hits += 1
+            return entry["data"]
+
+    def put(self, key, action, value):
+        now = time.time()
+        text = json.dumps(value)
+        with self.lock:
+            self.storeMemory(key, now, action, text)
+
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                fname = self.fileName(key)
+                tmp = "%s.%d.tmp" % (fname, os.getpid())
+                with open(tmp, "w") as f:
+                    f.write('{"action": %s, "time": %r, "data": %s}'
+                            % (json.dumps(action), now, text))
+                os.rename(tmp, fname)
+            except (IOError, OSError) as e:
+                print("Failed to write to DB cache: %s" % e)
+                return
+
+            self.evictDisk()
+
+    def storeMemory(self, key, stored, action, text):
+        self.memory[key] = (stored, action, text)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last = False)
+
+    def diskEntries(self):
+        "(mtime, size, file name) of each entry on disk, oldest first"
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for n in names:
+            if not n.endswith(".json"):
+                continue
+            fname = os.path.join(self.directory, n)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        entries.sort()
+        return entries
+
+    def evictDisk(self):
+        entries = self.diskEntries()
+        total = sum(e[1] for e in entries)
+        while entries and (len(entries) > self.max_disk_entries
+                           or total > self.max_disk_bytes):
+            mtime, size, fname = entries.pop(0)
+            self.remove(fname)
+            total -= size
+
+    def remove(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    def invalidate(self, action = None):
+        "Drop everything, or only the responses for one action"
+        if action is not None:
+            action = splitAction(action)[0]
+
+        with self.lock:
+            for k in list(self.memory.keys()):
+                if action is None or self.memory[k][1] == action:
+                    del self.memory[k]
+
+            for mtime, size, fname in self.diskEntries():
+                if action is not None:
+                    try:
+                        with open(fname) as f:
+                            if json.load(f)["action"] != action:
+                                continue
+                    except (IOError, OSError, ValueError, KeyError):
+                        pass
+                self.remove(fname)
@@ -0,0 +1,164 @@
+#!/bin/env python3
+
+# Streaming multipart/form-data encoder, for sending large attachments
+# without holding them in memory.
+#
+# requests builds the whole body of files=... in memory first. An
+# encoder is instead passed as data=: requests takes the length from
+# its len attribute, and http.client reads it a block at a time as it
+# sends. Files are read as they are needed, so memory use doesn't
+# depend on their size.
+
+import mimetypes
+import os
+import sys
+import time
+import uuid
+
+def quoteParam(s):
+    "Value for a name= or filename= parameter in a part header"
+    return s.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+def remainingSize(f):
+    "Bytes from the current position to the end of a file object"
+    start = f.tell()
+    try:
+        return os.fstat(f.fileno()).st_size - start
+    except (AttributeError, OSError, ValueError):
+        f.seek(0, os.SEEK_END)
+        size = f.tell() - start
+        f.seek(start)
+        return size
+
+class MultipartEncoder(object):
+    """File-like multipart/form-data body of fields and files
+
+    fields: {name: value}
+    files: {name: file object, or (file name, file object[, content type])}
+    progress: called as progress(bytes read, total) after each read
+    """
+    def __init__(self, fields = None, files = None, boundary = None, progress = None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.progress = progress
+
+        # The body, as bytes and (file object, start, size) for file contents
+        self.pieces = []
+        for name, value in (fields or {}).items():
+            if value is None:
+                continue
+            if not isinstance(value, (bytes, str)):
+                value = str(value)
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            self.pieces.append(self.partHeader(name) + value + b"\r\n")
+
+        for name, f in (files or {}).items():
+            filename = None
+            content_type = None
+            if isinstance(f, tuple):
+                if len(f) > 2:
+                    content_type = f[2]
+                filename, f = f[0], f[1]
+            if filename is None:
+                filename = os.path.basename(getattr(f, "name", name))
+            if content_type is None:
+                content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            self.pieces.append(self.partHeader(name, filename, content_type))
+            if isinstance(f, (bytes, str)):
+                self.pieces.append(f.encode("utf-8") if isinstance(f, str) else f)
+            else:
+                self.pieces.append((f, f.tell(), remainingSize(f)))
+            self.pieces.append(b"\r\n")
+
+        self.pieces.append(("--%s--\r\n" % self.boundary).encode("ascii"))
+
+        self.len = sum(p[2] if isinstance(p, tuple) else len(p) for p in self.pieces)
+        self.rewind()
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary=%s" % self.boundary
+
+    def partHeader(self, name, filename = None, content_type = None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (self.boundary, quoteParam(name))
+        if filename is not None:
+            header += '; filename="%s"' % quoteParam(filename)
+        if content_type is not None:
+            header += "\r\nContent-Type: %s" % content_type
+        return (header + "\r\n\r\n").encode("utf-8")
+
+    def rewind(self):
+        "Go back to the start, so the body can be sent again"
+        self.index = 0
+        self.offset = 0
+        self.position = 0
+        for p in self.pieces:
+            if isinstance(p, tuple):
+                p[0].seek(p[1])
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self.len - self.position
+
+        out = []
+        wanted = size
+        while wanted > 0 and self.index < len(self.pieces):
+            p = self.pieces[self.index]
+            if isinstance(p, tuple):
+                f, start, length = p
+                chunk = f.read(min(wanted, length - self.offset))
+                if not chunk and self.offset < length:
+                    raise IOError("%s shrank while being sent" % getattr(f, "name", "File"))
+            else:
+                chunk = p[self.offset : self.offset + wanted]
+                length = len(p)
+            out.append(chunk)
+            self.offset += len(chunk)
+            wanted -= len(chunk)
+            if self.offset >= length:
+                self.index += 1
+                self.offset = 0
+
+        data = b"".join(out)
+        self.position += len(data)
+        if self.progress is not None and data:
+            self.progress(self.position, self.len)
+        return data
+
+def formatBytes(n):
+    for unit in ["B", "kB", "MB", "GB"]:
+        if abs(n) < 1024 or unit == "GB":
+            return "%.1f %s" % (n, unit)
+        n /= 1024.
+
+class ProgressPrinter(object):
+    "Progress callback, printing the amount sent and throughput on one line"
+    def __init__(self, label = "Upload", interval = 0.5, f = None):
+        self.label = label
+        self.interval = interval
+        self.f = f or sys.stderr
+        self.start = None
+        self.last = 0
+        self.sent = 0
+
+    def __call__(self, sent, total):
+        now = time.time()
+        if self.start is None or sent < self.sent:
+            # First read, or started again after a retry
+            self.start = now
+            self.last = now
+        self.sent = sent
+        if sent < total and now - self.last < self.interval:
+            return
+        self.last = now
+
+        elapsed = max(now - self.start, 1e-6)
+        self.f.write("\r%s: %s / %s (%3d%%) %s/s   " % (self.label, formatBytes(sent), formatBytes(total),
+                                                     100 * sent // max(total, 1),
+                                                     formatBytes(sent / elapsed)))
+        if sent >= total:
+            self.f.write("\n")
+        self.f.flush()
@@ -0,0 +1,214 @@
+#!/bin/env python3
+
+# Fast output of DB responses, as an alternative to printDict.
+#
+# Items are rendered as they arrive (eg. page by page from iterList),
+# by walking each one with an explicit stack rather than recursion,
+# into one buffered writer which encodes for the terminal once per
+# block instead of once per field.
+#
+# Formats:
+#   tree   every field, nested with tabs, short lists on one line
+#   table  aligned columns of the scalar fields (widths from the first rows)
+#   jsonl  one json object per line
+#   csv    flattened fields, nested keys joined with "."
+
+import csv
+import json
+import sys
+
+formats = ["tree", "table", "jsonl", "csv"]
+
+class BufferedWriter(object):
+    """Collects text and writes it encoded in blocks, characters the
+    output can't show are replaced (as fix_encoding does)"""
+    def __init__(self, f = None, block = 1 << 16):
+        if f is None:
+            f = sys.stdout
+        # Anything already printed goes first
+        f.flush()
+        self.encoding = getattr(f, "encoding", None) or "utf-8"
+        self.raw = getattr(f, "buffer", None)
+        self.f = f
+        self.block = block
+        self.pending = []
+        self.size = 0
+
+    def write(self, s):
+        self.pending.append(s)
+        self.size += len(s)
+        if self.size >= self.block:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+        self.size = 0
+        if self.raw is not None:
+            self.raw.write(text.encode(self.encoding, "replace"))
+            self.raw.flush()
+        else:
+            self.f.write(text.encode(self.encoding, "replace").decode(self.encoding))
+            self.f.flush()
+
+def scalarText(v):
+    if v is None:
+        return "null"
+    if v is True:
+        return "true"
+    if v is False:
+        return "false"
+    if isinstance(v, str):
+        return v
+    if isinstance(v, (list, dict)):
+        return json.dumps(v, ensure_ascii = False)
+    return str(v)
+
+def isScalar(v):
+    return not isinstance(v, (dict, list))
+
+def renderTree(items, w):
+    """Each item as indented "key: value" lines, lists of plain values
+    on one line and other lists as numbered entries"""
+    write = w.write
+    for n, item in enumerate(items):
+        lines = ["item %d\n" % n]
+        append = lines.append
+        if not isinstance(item, dict):
+            item = {"value": item}
+
+        # Iterators over the entries of each open dict or list, which
+        # carry on from where they were when a nested one is finished
+        stack = [(iter(item.items()), "\t")]
+        while stack:
+            entries, indent = stack[-1]
+            for key, v in entries:
+                t = type(v)
+                if t is str:
+                    append("%s%s: %s\n" % (indent, key, v))
+                elif t is dict:
+                    if not v:
+                        append("%s%s: {}\n" % (indent, key))
+                        continue
+                    append("%s%s:\n" % (indent, key))
+                    stack.append((iter(v.items()), indent + "\t"))
+                    break
+                elif t is list:
+                    if all(isScalar(c) for c in v):
+                        append("%s%s: [%s]\n" % (indent, key, ", ".join(scalarText(c) for c in v)))
+                        continue
+                    append("%s%s (%d)\n" % (indent, key, len(v)))
+                    stack.append((iter([("[%d]" % i, c) for i, c in enumerate(v)]), indent + "\t"))
+                    break
+                else:
+                    append("%s%s: %s\n" % (indent, key, scalarText(v)))
+            else:
+                stack.pop()
+        write("".join(lines))
+
+def flatten(item):
+    "{dotted key: scalar or list} of a nested item"
+    flat = {}
+    stack = [("", item)]
+    while stack:
+        prefix, v = stack.pop()
+        if isinstance(v, dict) and v:
+            for k, c in v.items():
+                stack.append((prefix + k + "." if isinstance(c, dict) else prefix + k, c))
+        elif isinstance(v, dict):
+            flat[prefix.rstrip(".")] = {}
+        else:
+            flat[prefix] = v
+    return flat
+
+def orderedKeys(item, flat):
+    "Flattened keys in the order the fields appear in item"
+    keys = []
+    stack = [("", item)]
+    while stack:
+        prefix, v = stack.pop()
+        children = []
+        for k, c in v.items():
+            if isinstance(c, dict) and c:
+                children.append((prefix + k + ".", c))
+            else:
+                keys.append(prefix + k)
+        stack.extend(reversed(children))
+    return [k for k in keys if k in flat]
+
+def renderJsonLines(items, w):
+    dumps = json.JSONEncoder(ensure_ascii = False, separators = (",", ":")).encode
+    for item in items:
+        w.write(dumps(item) + "\n")
+
+def renderCSV(items, w, columns = None):
+    """Columns are the fields of the first item, unless given, later
+    items with other fields only fill in those columns"""
+    writer = csv.writer(w, lineterminator = "\n")
+    for item in items:
+        flat = flatten(item) if isinstance(item, dict) else {"value": item}
+        if columns is None:
+            columns = orderedKeys(item, flat) if isinstance(item, dict) else ["value"]
+            writer.writerow(columns)
+        writer.writerow([scalarText(flat[c]) if c in flat else "" for c in columns])
+
+def renderTable(items, w, columns = None, sample = 100, max_width = 40):
+    """Scalar fields in columns, sized to fit the first sample rows
+    (longer values later on push the row out of line)"""
+    rows = []
+    widths = None
+    for item in items:
+        flat = flatten(item) if isinstance(item, dict) else {"value": item}
+        if columns is None:
+            columns = [k for k in (orderedKeys(item, flat) if isinstance(item, dict) else ["value"])
+                       if not isinstance(flat[k], (list, dict))]
+        cells = []
+        for c in columns:
+            text = scalarText(flat.get(c, "")).replace("\n", " ")
+            if len(text) > max_width:
+                text = text[: max_width - 3] + "..."
+            cells.append(text)
+
+        if widths is None:
+            rows.append(cells)
+            if len(rows) < sample:
+                continue
+            widths = tableWidths(columns, rows, w)
+            for r in rows:
+                writeRow(r, widths, w)
+            rows = []
+        else:
+            writeRow(cells, widths, w)
+
+    if widths is None and columns is not None:
+        widths = tableWidths(columns, rows, w)
+        for r in rows:
+            writeRow(r, widths, w)
+
+def tableWidths(columns, rows, w):
+    widths = [max([len(c)] + [len(r[i]) for r in rows]) for i, c in enumerate(columns)]
+    writeRow(columns, widths, w)
+    writeRow(["-" * n for n in widths], widths, w)
+    return widths
+
+def writeRow(cells, widths, w):
+    w.write("  ".join(c.ljust(n) for c, n in zip(cells, widths)).rstrip() + "\n")
+
+def render(items, format = "tree", f = None, columns = None):
+    "Write an iterable of DB items to f (default stdout)"
+    if format not in formats:
+        raise ValueError("Unknown format %s, choose from %s" % (format, ", ".join(formats)))
+    w = BufferedWriter(f)
+    try:
+        if format == "tree":
+            renderTree(items, w)
+        elif format == "jsonl":
+            renderJsonLines(items, w)
+        elif format == "csv":
+            renderCSV(items, w, columns)
+        else:
+            renderTable(items, w, columns)
+    finally:
+        w.flush()
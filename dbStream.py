@@ -0,0 +1,139 @@
+#!/bin/env python3
+
+# Incremental parsing of large list responses.
+#
+# r.json() needs the whole body as a string and then as objects, both
+# at once. A StreamedResponse instead reads the body from the socket
+# a chunk at a time and decodes the entries of its pageItemList (or
+# itemList) one by one, so only one entry (and one chunk) need be in
+# memory, and the first entries are available before the rest have
+# arrived. The other members of the top-level object (pageInfo,
+# uuAppErrorMap...) are kept in meta as they are passed.
+
+import codecs
+import json
+
+list_keys = ["pageItemList", "itemList"]
+
+chunk_size = 1 << 16
+
+decoder = json.JSONDecoder()
+whitespace = " \t\n\r"
+
+class StreamedResponse(object):
+    def __init__(self, r):
+        "r a requests response, made with stream=True"
+        self.r = r
+        self.chunks = r.iter_content(chunk_size)
+        self.text = codecs.getincrementaldecoder(r.encoding or "utf-8")("replace")
+        self.buf = ""
+        self.pos = 0
+        self.ended = False
+        self.meta = {}
+        self.list_key = None
+        self.done = False
+        self.started = False
+
+    def more(self):
+        "Read the next chunk into the buffer, False at the end of the body"
+        if self.ended:
+            return False
+        if self.pos > chunk_size:
+            # Drop what's been parsed
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += self.text.decode(chunk)
+                return True
+        self.buf += self.text.decode(b"", True)
+        self.ended = True
+        self.r.close()
+        return False
+
+    def skip(self):
+        "Move past whitespace, return the next character ('' at the end)"
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, c):
+        if self.skip() != c:
+            raise ValueError("Expected '%s' at %d of response: %r"
+                             % (c, self.pos, self.buf[self.pos : self.pos + 40]))
+        self.pos += 1
+
+    def value(self):
+        "Decode the next complete json value, reading as much as it needs"
+        self.skip()
+        while True:
+            try:
+                v, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.more():
+                    continue
+                raise
+            # A number could carry on in the next chunk
+            if end == len(self.buf) and not self.ended and self.buf[end - 1] not in '"]}el':
+                if self.more():
+                    continue
+            self.pos = end
+            return v
+
+    def items(self):
+        """Generate the entries of the list, the members of the object
+        before and after it are put in meta"""
+        if self.started:
+            raise RuntimeError("Response already read")
+        self.started = True
+
+        self.expect("{")
+        if self.skip() == "}":
+            self.pos += 1
+            self.done = True
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            if key in list_keys and self.list_key is None and self.skip() == "[":
+                self.list_key = key
+                self.pos += 1
+                if self.skip() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        v = self.value()
+                        yield v
+                        c = self.skip()
+                        self.pos += 1
+                        if c == "]":
+                            break
+                        if c != ",":
+                            raise ValueError("Expected ',' or ']' in %s, not %r" % (key, c))
+            else:
+                self.meta[key] = self.value()
+
+            c = self.skip()
+            self.pos += 1
+            if c == "}":
+                break
+            if c != ",":
+                raise ValueError("Expected ',' or '}' in response, not %r" % c)
+        self.done = True
+        self.r.close()
+
+    def finish(self):
+        "Read to the end (skipping any entries not used), so meta is complete"
+        if not self.started:
+            for i in self.items():
+                pass
+        elif not self.done:
+            raise RuntimeError("Response only partly read")
+        return self.meta
+
+    def close(self):
+        self.r.close()
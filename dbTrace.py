@@ -0,0 +1,180 @@
+#!/bin/env python3
+
+# Per-request instrumentation of dbAccess.
+#
+# For each request (including its retries) a trace is passed to every
+# registered sink:
+#   action, method, status, retries, cached
+#   bytes_sent, bytes_received (request and response bodies)
+#   dns, connect, ttfb, total (seconds, dns and connect are 0 when a
+#   pooled connection was reused; total includes retries and backoff)
+#
+# Sinks are anything with record(trace) and close(), see
+# JsonLinesSink, HistogramSink and SummarySink. dbAccess.setupTracing
+# adds them, also done from ITK_DB_TRACE (json lines file) and
+# ITK_DB_TRACE_SUMMARY (print a summary at exit).
+
+import atexit
+import json
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+sinks = []
+
+def addSink(sink):
+    sinks.append(sink)
+    return sink
+
+def removeSink(sink):
+    if sink in sinks:
+        sinks.remove(sink)
+    sink.close()
+
+def enabled():
+    return len(sinks) > 0
+
+def makeTrace(action, method):
+    t = OrderedDict()
+    t["time"] = time.time()
+    t["action"] = action
+    t["method"] = method
+    t["status"] = None
+    t["retries"] = 0
+    t["cached"] = False
+    t["bytes_sent"] = 0
+    t["bytes_received"] = 0
+    t["dns"] = 0.
+    t["connect"] = 0.
+    t["ttfb"] = 0.
+    t["total"] = 0.
+    return t
+
+def emit(trace):
+    for sink in list(sinks):
+        try:
+            sink.record(trace)
+        except Exception as e:
+            print("Trace sink %s failed: %s" % (type(sink).__name__, e))
+
+def bodySize(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    # Streamed body
+    size = getattr(body, "len", None)
+    if size is None:
+        size = len(body) if hasattr(body, "__len__") else 0
+    return size
+
+def fillFromResponse(trace, r, stream = False):
+    """Sizes and timings of the (final) attempt of a request, a streamed
+    body isn't read yet so its size is taken from the headers"""
+    trace["status"] = r.status_code
+    trace["bytes_sent"] = bodySize(r.request.body)
+    if stream:
+        trace["bytes_received"] = int(r.headers.get("Content-Length") or 0)
+    else:
+        trace["bytes_received"] = len(r.content)
+    timing = getattr(r, "connection_timing", None) or {}
+    trace["dns"] = timing.get("dns", 0.)
+    trace["connect"] = timing.get("connect", 0.)
+    # elapsed runs from sending (including any connect) to the headers
+    trace["ttfb"] = max(r.elapsed.total_seconds() - trace["dns"] - trace["connect"], 0.)
+
+class JsonLinesSink(object):
+    "Append each trace to a file as one line of json"
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.f = open(fname, "a")
+
+    def record(self, trace):
+        line = json.dumps(trace) + "\n"
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+class HistogramSink(object):
+    "Counts, sizes and a latency histogram per action, in memory"
+
+    # Upper edges of the total latency buckets, in seconds
+    bounds = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf")]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.actions = {}
+
+    def record(self, trace):
+        with self.lock:
+            a = self.actions.get(trace["action"])
+            if a is None:
+                a = {"count": 0, "errors": 0, "retries": 0, "cached": 0,
+                     "bytes_sent": 0, "bytes_received": 0, "max": 0.,
+                     "dns": 0., "connect": 0., "ttfb": 0., "total": 0.,
+                     "buckets": [0] * len(self.bounds)}
+                self.actions[trace["action"]] = a
+            a["count"] += 1
+            if not trace["cached"] and trace["status"] != 200:
+                a["errors"] += 1
+            a["retries"] += trace["retries"]
+            a["cached"] += int(trace["cached"])
+            for k in ["bytes_sent", "bytes_received", "dns", "connect", "ttfb", "total"]:
+                a[k] += trace[k]
+            a["max"] = max(a["max"], trace["total"])
+            for ind, edge in enumerate(self.bounds):
+                if trace["total"] <= edge:
+                    a["buckets"][ind] += 1
+                    break
+
+    def percentile(self, action, q):
+        "Upper edge of the bucket holding the q'th percentile"
+        with self.lock:
+            a = self.actions[action]
+            target = q / 100. * a["count"]
+            seen = 0
+            for edge, n in zip(self.bounds, a["buckets"]):
+                seen += n
+                if seen >= target:
+                    return min(edge, a["max"])
+        return a["max"]
+
+    def printSummary(self, f = None):
+        if f is None:
+            f = sys.stdout
+        f.write(" ==== Requests =====\n")
+        f.write("%-28s %6s %5s %6s %6s %9s %9s %8s %8s %8s %8s %8s %8s\n"
+                % ("action", "count", "err", "retry", "cached", "sent kB", "recv kB",
+                   "dns", "connect", "ttfb", "mean", "p90", "max"))
+        for action in sorted(self.actions):
+            a = self.actions[action]
+            n = a["count"]
+            f.write("%-28s %6d %5d %6d %6d %9.1f %9.1f %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f\n"
+                    % (action, n, a["errors"], a["retries"], a["cached"],
+                       a["bytes_sent"] / 1024., a["bytes_received"] / 1024.,
+                       a["dns"] / n, a["connect"] / n, a["ttfb"] / n, a["total"] / n,
+                       self.percentile(action, 90), a["max"]))
+
+    def close(self):
+        pass
+
+class SummarySink(HistogramSink):
+    "HistogramSink printing its summary when the program exits"
+    def __init__(self, f = None):
+        HistogramSink.__init__(self)
+        self.f = f
+        self.printed = False
+        atexit.register(self.close)
+
+    def close(self):
+        if self.printed or len(self.actions) == 0:
+            return
+        self.printed = True
+        self.printSummary(self.f)
@@ -3,5 +3,6 @@ import dbAccess
 
 if __name__ == "__main__":
     token = dbAccess.authenticate()
+    dbAccess.tokenManager.save(token)
     print("export ITK_DB_AUTH=%s" % token)
 
@@ -0,0 +1,436 @@
+#!/bin/env python3
+
+# Local stand-in for the production database, for testing and
+# benchmarking dbAccess without network access.
+#
+# Run it and point the tools at it:
+#   ./mockDB.py --port 8642 --latency 0.05 --fail-rate 0.05 &
+#   export ITK_DB_URL=http://localhost:8642/ ITK_DB_AUTH_URL=http://localhost:8642/
+#
+# Serves grantToken, the list*/get* actions with paging,
+# uploadTestRunResults, createComponentComment and
+# createComponentAttachment. Tokens expire after --token-lifetime
+# seconds with the same 401 as the real DB. GET /_stats returns the
+# number of requests and bytes received per action.
+
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    print("mockDB needs Python 3.7 or later")
+    raise
+
+def MakeToken(lifetime):
+    "Unsigned JWT-like id_token, enough for dbAccess to read the expiry"
+    claims = {"exp": time.time() + lifetime, "jti": uuid.uuid4().hex}
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode("utf-8")).decode("ascii").rstrip("=")
+    return "mock.%s.unsigned" % payload
+
+def ErrorMap(key, message, **info):
+    info["message"] = message
+    return {"uuAppErrorMap": {key: info}}
+
+class MockDB(object):
+    "Contents of the fake database, shared by the request threads"
+    def __init__(self, components = 100, token_lifetime = 3600):
+        self.lock = threading.Lock()
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.stats = {}
+
+        self.institutions = [{"code": "UNI%c" % c, "name": u"Universit\xe4t %c" % c,
+                              "supervisor": "Supervisor %c" % c} for c in "ABCDEF"]
+        self.projects = [{"code": "S", "name": "Strips"}, {"code": "P", "name": "Pixels"}]
+        self.component_types = [{"code": code, "name": name, "project": "S",
+                                 "state": "active", "subprojects": [], "stages": [], "types": []}
+                                for code, name in [("MODULE", "Module"), ("STAVE", "Stave"),
+                                                   ("SENSOR", "Sensor"), ("HYBRID", "Hybrid")]]
+        self.test_types = {}
+        for t in self.component_types:
+            self.test_types[t["code"]] = [
+                {"code": "SURVEY-AG", "name": "Survey after gluing", "state": "active",
+                 "componentType": t["code"],
+                 "properties": [{"code": "MODULE_NUM", "name": "Module number", "dataType": "string",
+                                 "valueType": "single", "required": True},
+                                {"code": "GLUETIME", "name": "Glue time", "dataType": "string",
+                                 "valueType": "single", "required": False},
+                                {"code": "FIDUCIAL", "name": "Fiducial", "dataType": "string",
+                                 "valueType": "single", "required": False},
+                                {"code": "ASSEMBLER", "name": "Assembler", "dataType": "string",
+                                 "valueType": "single", "required": False},
+                                {"code": "SITE", "name": "Site", "dataType": "string",
+                                 "valueType": "single", "required": False}],
+                 "parameters": [{"code": c, "name": "Corner %s" % c, "dataType": "float",
+                                 "valueType": "array", "required": True} for c in "ABCD"]},
+                {"code": "SURVEY-BBR", "name": "Survey before bridge removal", "state": "active",
+                 "componentType": t["code"],
+                 "properties": [{"code": "MODULE_NUM", "name": "Module number", "dataType": "string",
+                                 "valueType": "single", "required": True},
+                                {"code": "FIDUCIAL", "name": "Fiducial", "dataType": "string",
+                                 "valueType": "single", "required": False},
+                                {"code": "ASSEMBLER", "name": "Assembler", "dataType": "string",
+                                 "valueType": "single", "required": False}],
+                 "parameters": [{"code": c, "name": "Corner %s" % c, "dataType": "float",
+                                 "valueType": "array", "required": True} for c in "ABCD"]}]
+
+        # Full test runs by id, components only list a summary of each
+        self.test_runs = {}
+
+        self.components = {}
+        for ind in range(components):
+            self.AddComponent("%032x" % ind, "MODULE")
+
+    def AddComponent(self, code, componentType):
+        c = {"code": code, "serialNumber": "20USEM%08d" % len(self.components),
+             "componentType": componentType, "project": "S", "state": "ready",
+             "currentStage": "ASSEMBLY", "institution": "UNIA",
+             "tests": [], "comments": [], "attachments": []}
+        self.components[code] = c
+        return c
+
+    def Component(self, code):
+        with self.lock:
+            c = self.components.get(code)
+            if c is None:
+                # Accept uploads for components we haven't heard of
+                c = self.AddComponent(code, "MODULE")
+            return c
+
+    def Grant(self):
+        token = MakeToken(self.token_lifetime)
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_lifetime
+        return token
+
+    def TokenValid(self, header):
+        if header is None or not header.startswith("Bearer "):
+            return False
+        with self.lock:
+            expiry = self.tokens.get(header[len("Bearer "):])
+        return expiry is not None and expiry > time.time()
+
+    def Count(self, action, received, status):
+        with self.lock:
+            s = self.stats.setdefault(action, {"requests": 0, "bytes": 0, "statuses": {}})
+            s["requests"] += 1
+            s["bytes"] += received
+            s["statuses"][str(status)] = s["statuses"].get(str(status), 0) + 1
+
+def Page(items, data, page_size):
+    "One page of items, with pageInfo as the DB sends it"
+    info = data.get("pageInfo") or {}
+    index = int(info.get("pageIndex", 0))
+    size = int(info.get("pageSize", page_size))
+    return {"pageItemList": items[index * size : (index + 1) * size],
+            "pageInfo": {"pageIndex": index, "pageSize": size, "total": len(items)},
+            "uuAppErrorMap": {}}
+
+def ParseMultipart(body, content_type):
+    "Fields of a multipart/form-data body, files as (file name, size)"
+    boundary = None
+    for part in content_type.split(";"):
+        part = part.strip()
+        if part.startswith("boundary="):
+            boundary = part[len("boundary="):].strip('"')
+    if boundary is None:
+        return None
+
+    fields = {}
+    for part in body.split(b"--" + boundary.encode("ascii")):
+        if b"\r\n\r\n" not in part:
+            continue
+        head, value = part.split(b"\r\n\r\n", 1)
+        if value.endswith(b"\r\n"):
+            value = value[:-2]
+        head = head.decode("utf-8", "replace")
+        name = None
+        filename = None
+        for item in head.replace("\r\n", ";").split(";"):
+            item = item.strip()
+            if item.startswith("name="):
+                name = item[len("name="):].strip('"')
+            elif item.startswith("filename="):
+                filename = item[len("filename="):].strip('"')
+        if name is None:
+            continue
+        if filename is not None:
+            fields[name] = (filename, len(value))
+        else:
+            fields[name] = value.decode("utf-8", "replace")
+    return fields
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't wait for an ack between
+    disable_nagle_algorithm = True
+
+    # Set by StartServer
+    db = None
+    options = None
+
+    def log_message(self, format, *args):
+        if self.options.get("verbose"):
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def ReadBody(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def Send(self, status, j, headers = None):
+        body = json.dumps(j).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        return status
+
+    def do_GET(self):
+        self.Handle()
+
+    def do_POST(self):
+        self.Handle()
+
+    def Handle(self):
+        action = self.path.split("?")[0].rstrip("/").split("/")[-1]
+        body = self.ReadBody()
+        status = self.Respond(action, body)
+        self.db.Count(action, len(body), status)
+
+    def Respond(self, action, body):
+        options = self.options
+
+        if action == "_stats":
+            with self.db.lock:
+                return self.Send(200, self.db.stats)
+
+        if options["latency"] or options["jitter"]:
+            time.sleep(options["latency"] + random.uniform(0, options["jitter"]))
+
+        if random.random() < options["drop_rate"]:
+            # Connection reset without a response
+            self.close_connection = True
+            self.wfile.flush()
+            self.connection.close()
+            return "dropped"
+
+        if random.random() < options["fail_rate"]:
+            status = random.choice(options["fail_statuses"])
+            headers = {}
+            if status in [429, 503] and options["retry_after"] is not None:
+                headers["Retry-After"] = str(options["retry_after"])
+            return self.Send(status, ErrorMap("mock/injectedFailure", "Injected failure"), headers)
+
+        data = {}
+        if action == "createComponentAttachment":
+            data = ParseMultipart(body, self.headers.get("Content-Type", ""))
+            if data is None:
+                return self.Send(400, ErrorMap("mock/invalidMultipart", "Expected multipart/form-data"))
+        elif body:
+            try:
+                data = json.loads(body.decode("utf-8"))
+            except ValueError:
+                return self.Send(400, ErrorMap("mock/invalidJson", "Body is not json"))
+
+        # Query string parameters, as in listComponentTypes?project=S
+        if "?" in self.path:
+            for p in self.path.split("?", 1)[1].split("&"):
+                if "=" in p:
+                    k, v = p.split("=", 1)
+                    data.setdefault(k, v)
+
+        if action == "grantToken":
+            if "accessCode1" not in data or "accessCode2" not in data:
+                return self.Send(400, ErrorMap("uu-oidc/invalidCredentials", "Need access codes"))
+            return self.Send(200, {"id_token": self.db.Grant(), "uuAppErrorMap": {}})
+
+        if not self.db.TokenValid(self.headers.get("Authorization")):
+            return self.Send(401, ErrorMap("uu-oidc/invalidToken", "Token is invalid or expired"))
+
+        handler = getattr(self, "action_" + action, None)
+        if handler is None:
+            return self.Send(400, ErrorMap("cern-itkpd-main/%s/unknownAction" % action,
+                                           "Unknown action %s" % action))
+        return handler(data)
+
+    def Missing(self, action, data, keys):
+        missing = [k for k in keys if k not in data]
+        if not missing:
+            return None
+        return self.Send(400, ErrorMap("cern-itkpd-main/%s/invalidDtoIn" % action, "DtoIn is not valid",
+                                       paramMap = {"missingKeyMap": dict(("$.%s" % k, {"$": "required"})
+                                                                         for k in missing)}))
+
+    def action_listInstitutions(self, data):
+        return self.Send(200, Page(self.db.institutions, data, self.options["page_size"]))
+
+    def action_listProjects(self, data):
+        return self.Send(200, Page(self.db.projects, data, self.options["page_size"]))
+
+    def action_listComponentTypes(self, data):
+        types = [t for t in self.db.component_types if t["project"] == data.get("project", "S")]
+        return self.Send(200, Page(types, data, self.options["page_size"]))
+
+    def action_listTestTypes(self, data):
+        error = self.Missing("listTestTypes", data, ["project", "componentType"])
+        if error:
+            return error
+        if data["componentType"] not in self.db.test_types:
+            return self.Send(400, ErrorMap("cern-itkpd-main/listTestTypes/componentTypeDaoGetByCodeFailed",
+                                           "Component type not found"))
+        return self.Send(200, Page(self.db.test_types[data["componentType"]], data, self.options["page_size"]))
+
+    def action_listComponents(self, data):
+        with self.db.lock:
+            components = [c for c in self.db.components.values()
+                          if "componentType" not in data or c["componentType"] == data["componentType"]]
+        return self.Send(200, Page(components, data, self.options["page_size"]))
+
+    def action_getComponent(self, data):
+        error = self.Missing("getComponent", data, ["component"])
+        if error:
+            return error
+        with self.db.lock:
+            c = self.db.components.get(data["component"])
+            if c is None:
+                for other in self.db.components.values():
+                    if other["serialNumber"] == data["component"]:
+                        c = other
+            if c is not None:
+                c = json.loads(json.dumps(c))
+        if c is None:
+            return self.Send(400, ErrorMap("cern-itkpd-main/getComponent/componentDaoGetFailed",
+                                           "Component not found"))
+        c["uuAppErrorMap"] = {}
+        return self.Send(200, c)
+
+    def action_uploadTestRunResults(self, data):
+        error = self.Missing("uploadTestRunResults", data, ["component", "testType", "institution", "results"])
+        if error:
+            return error
+        c = self.db.Component(data["component"])
+        date = data.get("date", "")
+        if "." in date:
+            date = "-".join(reversed(date.split(".")))
+        run = {"id": uuid.uuid4().hex, "runNumber": data.get("runNumber"), "date": date,
+               "passed": data.get("passed"), "state": "ready"}
+        full = dict(run, component = c["code"], testType = data["testType"],
+                    institution = data["institution"],
+                    results = [{"code": k, "value": v} for k, v in data["results"].items()],
+                    properties = [{"code": k, "value": v}
+                                  for k, v in (data.get("properties") or {}).items()])
+        with self.db.lock:
+            self.db.test_runs[run["id"]] = full
+            for t in c["tests"]:
+                if t["code"] == data["testType"]:
+                    t["testRuns"].append(run)
+                    break
+            else:
+                c["tests"].append({"code": data["testType"], "testRuns": [run]})
+        return self.Send(200, {"testRun": run, "uuAppErrorMap": {}})
+
+    def action_getTestRun(self, data):
+        error = self.Missing("getTestRun", data, ["testRun"])
+        if error:
+            return error
+        with self.db.lock:
+            run = self.db.test_runs.get(data["testRun"])
+            if run is not None:
+                run = json.loads(json.dumps(run))
+        if run is None:
+            return self.Send(400, ErrorMap("cern-itkpd-main/getTestRun/testRunDaoGetFailed",
+                                           "Test run not found"))
+        run["uuAppErrorMap"] = {}
+        return self.Send(200, run)
+
+    def action_createComponentComment(self, data):
+        error = self.Missing("createComponentComment", data, ["component", "comments"])
+        if error:
+            return error
+        c = self.db.Component(data["component"])
+        with self.db.lock:
+            for comment in data["comments"]:
+                c["comments"].append({"code": uuid.uuid4().hex, "comment": comment,
+                                      "dateTime": time.strftime("%Y-%m-%dT%H:%M:%S")})
+        return self.Send(200, {"component": {"code": c["code"]}, "uuAppErrorMap": {}})
+
+    def action_createComponentAttachment(self, data):
+        error = self.Missing("createComponentAttachment", data, ["component", "data"])
+        if error:
+            return error
+        filename, size = data["data"]
+        c = self.db.Component(data["component"])
+        attachment = {"code": uuid.uuid4().hex, "filename": filename, "size": size,
+                      "title": data.get("title"), "description": data.get("description")}
+        with self.db.lock:
+            c["attachments"].append(attachment)
+        return self.Send(200, {"attachment": attachment, "uuAppErrorMap": {}})
+
+class Server(ThreadingHTTPServer):
+    # Room for the connections of an asyncio client opening many at once
+    request_queue_size = 256
+
+def StartServer(port = 0, components = 100, token_lifetime = 3600, page_size = 100,
+                latency = 0., jitter = 0., fail_rate = 0., fail_statuses = (502, 503),
+                retry_after = None, drop_rate = 0., verbose = False):
+    """Serve on localhost from a background thread, returns the server
+
+    The URL to use is "http://127.0.0.1:%d/" % server.server_port"""
+    handler = type("MockHandler", (Handler,), {})
+    handler.db = MockDB(components, token_lifetime)
+    handler.options = {"page_size": page_size, "latency": latency, "jitter": jitter,
+                       "fail_rate": fail_rate, "fail_statuses": list(fail_statuses),
+                       "retry_after": retry_after, "drop_rate": drop_rate, "verbose": verbose}
+
+    server = Server(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the production database")
+    parser.add_argument("--port", type=int, default=8642, help="Port to listen on (localhost only)")
+    parser.add_argument("--components", type=int, default=100, help="Number of MODULE components to create")
+    parser.add_argument("--page-size", type=int, default=100, help="Default page size of list actions")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="Seconds before tokens expire")
+    parser.add_argument("--latency", type=float, default=0., help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0., help="Up to this many more seconds at random")
+    parser.add_argument("--fail-rate", type=float, default=0., help="Fraction of requests to fail")
+    parser.add_argument("--fail-status", type=int, action="append", dest="fail_statuses",
+                        help="Status code of injected failures (repeat for several, default 502 and 503)")
+    parser.add_argument("--retry-after", type=float, default=None, help="Retry-After sent with 429 and 503")
+    parser.add_argument("--drop-rate", type=float, default=0., help="Fraction of connections to drop")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+
+    args = parser.parse_args()
+
+    server = StartServer(args.port, args.components, args.token_lifetime, args.page_size,
+                         args.latency, args.jitter, args.fail_rate, args.fail_statuses or (502, 503),
+                         args.retry_after, args.drop_rate, args.verbose)
+    print("Mock DB on http://127.0.0.1:%d/" % server.server_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
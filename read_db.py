@@ -30,6 +30,12 @@ class FunctionCommand(object):
         self.function(**kwargs)
 
 class StandardCommand(object):
+    # Output format for dbRender, None for the default printout
+    format = None
+    columns = None
+    # Parse list responses as they arrive, see dbStream
+    stream = False
+
     def __init__(self, *args):
         # type(args) is tuple
         self.action = args[0]
@@ -45,7 +51,10 @@ class StandardCommand(object):
         try:
             dbAccess.printGetList(self.action,
                                   method = "GET",
-                                  data = actionData)
+                                  data = actionData,
+                                  format = self.format,
+                                  output = self.columns,
+                                  stream = self.stream)
         except:
             if dbAccess.verbose:
                 print("Request failed:")
@@ -68,7 +77,8 @@ commands = {"stats": SC("getItkpdOverallStatistics", []),
             "list_test_types": SC("listTestTypes", ["project", "componentType"]),
             "list_commands": FC(list_commands, []),
             "get_component_info": SC("getComponent", ["component"]),
-            "summary": FC(dbAccess.summary, ["project"])
+            "summary": FC(dbAccess.summary, ["project"]),
+            "clear_cache": FC(dbAccess.invalidateCache, [])
             }
 
 if __name__ == "__main__":
@@ -79,6 +89,18 @@ if __name__ == "__main__":
     parser.add_argument("--project", help="Code for the project, defaults to 'S' for Strips")
     parser.add_argument("--verbose", action="store_true",
                         help="Print what's being sent and received")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't use cached responses for catalogue requests")
+    parser.add_argument("--format", choices=["tree", "table", "jsonl", "csv"],
+                        help="Output format for list and get commands (default: the original printout)")
+    parser.add_argument("--columns",
+                        help="Comma separated fields for table and csv output, eg. code,serialNumber,state")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read long lists an item at a time as they arrive, using less memory")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Append timings of each request to FILE (json lines)")
+    parser.add_argument("--trace-summary", action="store_true",
+                        help="Print a table of request timings per action at the end")
 
     args = parser.parse_args()
 
@@ -89,6 +111,20 @@ if __name__ == "__main__":
     if args.verbose:
         dbAccess.verbose = True
 
+    if args.no_cache:
+        dbAccess.use_cache = False
+
+    if args.format:
+        StandardCommand.format = args.format
+        if args.columns:
+            StandardCommand.columns = args.columns.split(",")
+
+    if args.stream:
+        StandardCommand.stream = True
+
+    if args.trace or args.trace_summary:
+        dbAccess.setupTracing(args.trace, summary = args.trace_summary)
+
     if os.getenv("ITK_DB_AUTH"):
         dbAccess.token = os.getenv("ITK_DB_AUTH")
 
@@ -124,3 +160,6 @@ if __name__ == "__main__":
             sys.exit(1)
 
     data.run(**extraData)
+
+    if dbAccess.verbose:
+        dbAccess.printConnectionStats()
@@ -1,11 +1,14 @@
 
 import argparse
+import collections
 import json
 import os, sys
 import numpy as np
 import ReadSurvey as RS
+import SurveyManifest
 import time
 import upload_test_results as uploadTest
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -180,6 +183,78 @@ def GetBBRJSON(survey,module,comp_code_path):
 
     return out
 
+def UploadModule(module, args, tests, manifest = None):
+    "Parse, evaluate and upload the tests of one module, return its status"
+    status = collections.OrderedDict()
+    status["module"] = module
+    status["glued"] = None
+    status["passed"] = None
+    for test in tests:
+        status[test] = "-"
+    status["error"] = ""
+
+    try:
+        name, infile, dir = ("Module" + str(module),"Module_" + str(module) + ".txt",
+                             args.survey_path+"ModulePlacement/"+str(module)+"/")
+        if manifest is not None:
+            survey = manifest.LoadSurvey(name, infile, dir)
+        else:
+            survey = RS.TheSurveys(name, infile, dir)
+    except Exception as e:
+        ERROR("failed to read survey of module %i: %s" % (module, e))
+        status["error"] = "parse: %s" % e
+        return status
+
+    status["glued"] = survey.glued
+    status["passed"] = survey.passed
+
+    if survey.glued:
+        if args.Testing is False:
+            import dbAccess
+
+            for test, GetJSON in [("SURVEY-AG", GetAGJSON), ("SURVEY-BBR", GetBBRJSON)]:
+                if test not in tests:
+                    continue
+                try:
+                    dto = json.loads(GetJSON(survey,module,args.comp_code_path))
+                    if manifest is not None and manifest.IsUploaded(survey, test, dto):
+                        status[test] = "unchanged"
+                        continue
+                    result = dbAccess.doSomething("uploadTestRunResults", dto)
+                    status[test] = "uploaded" if result is not None else "failed"
+                    if result is not None and manifest is not None:
+                        manifest.MarkUploaded(survey, test, dto)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                # dbAccess reports bad status codes with a BaseException
+                except BaseException as e:
+                    status[test] = "failed"
+                    error = "%s: %s" % (test, e)
+                    status["error"] = "%s; %s" % (status["error"], error) if status["error"] else error
+            print("%s passed:" % survey.name, survey.passed)
+        else:
+            STATUS("------Testing uploadStaveAssemblySurvey.py------")
+            survey.PrintTheFailures()
+    else:
+        print("%s not glued or survey information not in %s" % (survey.name,survey.infile))
+    print("------------------------------------------")
+
+    return status
+
+def PrintStatusTable(statuses, tests):
+    columns = ["module", "glued", "passed"] + list(tests) + ["error"]
+    widths = dict((c, len(c)) for c in columns)
+    for status in statuses:
+        for c in columns:
+            widths[c] = max(widths[c], len(str(status[c])))
+
+    print('')
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    print("  ".join("-" * widths[c] for c in columns))
+    for status in statuses:
+        print("  ".join(str(status[c]).ljust(widths[c]) for c in columns))
+    print('')
+
 def main(args):
     print('')
     print('*************************************************************************')
@@ -217,36 +292,47 @@ def main(args):
         tests=TestToUpload()
         if tests==[]:
             exit()
-        for module in modules:
-            survey = RS.TheSurveys("Module" + str(module),"Module_" + str(module) + ".txt",
-                    args.survey_path+"ModulePlacement/"+str(module)+"/")
-        #print(survey.name)
-        #print(survey.infile)
-
-            if survey.glued:
-                if args.Testing is False:
-                    import dbAccess
-
-                    if os.getenv("ITK_DB_AUTH"):
-                        dbAccess.token = os.getenv("ITK_DB_AUTH")
 
-                    if "SURVEY-AG" in tests:
-                        testFile1=GetAGJSON(survey,module,args.comp_code_path)
-                        dbAccess.doSomething("uploadTestRunResults", json.loads(testFile1))
-
-                    if "SURVEY-BBR" in tests:
-                        testFile2=GetBBRJSON(survey,module,args.comp_code_path)
-                        dbAccess.doSomething("uploadTestRunResults", json.loads(testFile2))
-                print("%s passed:" % survey.name, survey.passed)
+        if args.Testing is False:
+            import dbAccess
+
+            if args.trace or args.trace_summary:
+                dbAccess.setupTracing(args.trace, summary = args.trace_summary)
+
+            if os.getenv("ITK_DB_AUTH"):
+                dbAccess.token = os.getenv("ITK_DB_AUTH")
+
+            # Get the token before starting workers, so only one prompt
+            if dbAccess.token is None and not dbAccess.testing:
+                dbAccess.setupConnection()
+            if args.jobs > dbAccess.pool_size:
+                dbAccess.setupSession(pool_size = args.jobs)
+
+        manifest = None
+        if args.incremental:
+            manifest_path = args.manifest_path or os.path.join(args.survey_path, SurveyManifest.default_name)
+            manifest = SurveyManifest.SurveyManifest(manifest_path)
+
+        if args.jobs > 1:
+            STATUS("uploading %i modules with %i workers" % (len(modules), args.jobs))
+            pool = ThreadPoolExecutor(max_workers = args.jobs)
+            try:
+                statuses = list(pool.map(lambda m: UploadModule(m, args, tests, manifest), modules))
+            finally:
+                pool.shutdown()
+        else:
+            statuses = [UploadModule(module, args, tests, manifest) for module in modules]
 
+        PrintStatusTable(statuses, tests)
 
+        if manifest is not None:
+            if args.Testing is False:
+                manifest.Save()
+            manifest.PrintStats()
 
-                else:
-                    STATUS("------Testing uploadStaveAssemblySurvey.py------")
-                    survey.PrintTheFailures()
-            else:
-                print("%s not glued or survey information not in %s" % (survey.name,survey.infile))
-            print("------------------------------------------")
+        if args.Testing is False:
+            dbAccess.printConnectionStats()
+            dbAccess.printRetryStats()
     except GeneralError as e:
         ERROR(e.message)
         STATUS('Finished with error.\n')
@@ -267,6 +353,16 @@ if __name__ == '__main__':
 
     optional = parser.add_argument_group('optional arguments')
     optional.add_argument('--testing', dest = 'Testing', action = 'store_true', help = 'if only testing and DO NOT upload')
+    optional.add_argument('--jobs', dest = 'jobs', type = int, default = 1,
+                          help = 'number of modules to parse and upload concurrently (default 1)')
+    optional.add_argument('--incremental', dest = 'incremental', action = 'store_true',
+                          help = 'only parse and upload surveys which changed since the last run')
+    optional.add_argument('--manifest', dest = 'manifest_path', type = str, default = None,
+                          help = 'manifest file for --incremental (default: .survey_manifest.json in --surveyPath)')
+    optional.add_argument('--trace', dest = 'trace', type = str, default = None,
+                          help = 'append timings of each DB request to this file (json lines)')
+    optional.add_argument('--trace-summary', dest = 'trace_summary', action = 'store_true',
+                          help = 'print a table of DB request timings per action at the end')
 
     args = parser.parse_args()
 
@@ -1,47 +1,196 @@
 #!/bin/env python
 import os, sys
 import argparse
+import glob
+import hashlib
 import json
 
 import dbAccess
 
-def read_file(fname):
-    d = open(fname).read()
-    data = json.loads(d)
+def check_data(data):
+    "List of problems with the basic structure of test data"
+    errors = []
 
-    # Insert some more validation
+    if not isinstance(data, dict):
+        return ["Test data should be a json object"]
 
     if "component" not in data:
-        print("Need reference to component, hex string")
-        sys.exit(1)
+        errors.append("Need reference to component, hex string")
 
     if "testType" not in data:
-        print("Need to know test type, short code")
-        sys.exit(1)
+        errors.append("Need to know test type, short code")
 
     if "institution" not in data:
-        print("Need to know institution, short code")
-        sys.exit(1)
+        errors.append("Need to know institution, short code")
 
     if "results" not in data:
-        print("Need some test results")
-        sys.exit(1)
+        errors.append("Need some test results")
 
-    if "properties" in data:
+    if "properties" in data and not isinstance(data["properties"], dict):
+        errors.append("properties should be an object")
+    elif "properties" in data:
         for k,v in data["properties"].items():
             if v == "some_string":
-                print("This looks like a prototype file, property: %s" % k)
-                sys.exit(1)
+                errors.append("This looks like a prototype file, property: %s" % k)
+
+    return errors
+
+def read_file(fname):
+    d = open(fname).read()
+    data = json.loads(d)
+
+    # Insert some more validation
+
+    errors = check_data(data)
+    if errors:
+        print(errors[0])
+        sys.exit(1)
 
     return data
 
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def is_string(v):
+    return isinstance(v, str) or (sys.version_info[0] == 2 and isinstance(v, unicode))
+
+# Checks of each DB dataType, others accept anything
+type_checks = {"string": is_string,
+               "float": is_number,
+               "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+               "boolean": lambda v: isinstance(v, bool)}
+
+def array_of(check):
+    return lambda v: isinstance(v, list) and all(x is None or check(x) for x in v)
+
+# What the entries of each part of test data are called
+field_names = {"properties": "property", "results": "result"}
+
+def compile_fields(fields):
+    "{code: (required, check of the value)} from a list of DB property/parameter definitions"
+    compiled = {}
+    for f in fields or []:
+        check = type_checks.get(f.get("dataType"))
+        if check is not None and f.get("valueType") == "array":
+            check = array_of(check)
+        compiled[f["code"]] = (bool(f.get("required")), check, f.get("dataType"), f.get("valueType"))
+    return compiled
+
+class TestSchemas(object):
+    """Definitions of the test types of a component type, from
+    listTestTypes (so cached), compiled once each for checking files"""
+    def __init__(self, component_type, project = "S"):
+        self.component_type = component_type
+        test_types = dbAccess.extractList("listTestTypes", method = "GET",
+                                          data = {"project": project,
+                                                  "componentType": component_type})
+        self.schemas = {}
+        for t in test_types:
+            self.schemas[t["code"]] = {"properties": compile_fields(t.get("properties")),
+                                       "results": compile_fields(t.get("parameters"))}
+
+    def check(self, data):
+        "List of problems with test data, against its test type"
+        schema = self.schemas.get(data.get("testType"))
+        if schema is None:
+            return ["Unknown test type %s for %s, known: %s"
+                    % (data.get("testType"), self.component_type, ", ".join(sorted(self.schemas)))]
+
+        errors = []
+        for part in ["properties", "results"]:
+            values = data.get(part) or {}
+            if not isinstance(values, dict):
+                errors.append("%s should be an object" % part)
+                continue
+            for code, (required, check, dataType, valueType) in sorted(schema[part].items()):
+                if code not in values:
+                    if required:
+                        errors.append("Missing %s %s" % (field_names[part], code))
+                    continue
+                v = values[code]
+                if v is not None and check is not None and not check(v):
+                    errors.append("%s %s should be %s %s, not %s"
+                                  % (field_names[part], code, valueType or "single", dataType, json.dumps(v)))
+            for code in sorted(values):
+                if code not in schema[part]:
+                    errors.append("Unknown %s %s" % (field_names[part], code))
+        return errors
+
+def find_test_files(paths):
+    "json files named by paths, which may be directories or glob patterns"
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(sorted(glob.glob(os.path.join(p, "*.json"))))
+        else:
+            matches = sorted(glob.glob(p))
+            if not matches:
+                print("No files match %s" % p)
+            files.extend(matches)
+    return files
+
+def validate_files(files, schemas = None):
+    """Check every file, printing all the problems found
+    Returns {file name: data} of the ones without any"""
+    valid = {}
+    for fname in files:
+        try:
+            with open(fname) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            print("%s: can't read: %s" % (fname, e))
+            continue
+        errors = check_data(data)
+        if not errors and schemas is not None:
+            errors = schemas.check(data)
+        for e in errors:
+            print("%s: %s" % (fname, e))
+        if not errors:
+            valid[fname] = data
+    return valid
+
+def upload_files(valid, jobs, log_name):
+    "Upload checked test data, return the number which failed"
+    import dbBulk
+
+    items = []
+    for fname, data in sorted(valid.items()):
+        digest = hashlib.sha1(json.dumps(data, sort_keys = True).encode("utf-8")).hexdigest()[:12]
+        items.append(("%s:%s" % (fname, digest), (fname, data)))
+
+    def upload(item):
+        fname, data = item
+        result = dbAccess.doSomething("uploadTestRunResults", data, method = "POST")
+        if not isinstance(result, dict):
+            return "failed", {"file": fname, "error": "Unexpected response: %s" % result}
+        run = result.get("testRun") or {}
+        return "ok", {"file": fname, "testRun": run.get("id")}
+
+    log = dbBulk.ProgressLog(log_name)
+    try:
+        results = dbBulk.runBulk(items, upload, jobs, log)
+    finally:
+        log.close()
+    return dbBulk.printBulkSummary(results)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Upload test data to production database")
 
     parser.add_argument("--test-file", help="Name of json file with test data")
+    parser.add_argument("--test-files", nargs="+", metavar="PATH",
+                        help="Directories or glob patterns of json files, checked first then uploaded together")
+    parser.add_argument("--component-type",
+                        help="Check --test-files against the test types of this component type")
+    parser.add_argument("--project", default="S", help="Project of the component type")
+    parser.add_argument("--jobs", "-j", type=int, default=4,
+                        help="Number of files to upload at once")
+    parser.add_argument("--log", default="upload_test_results_log.jsonl",
+                        help="Progress log, files uploaded in an earlier run are not sent again")
 
     parser.add_argument("--verbose", action="store_true",
                         help="Print what's being sent and received")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't use cached responses for catalogue requests")
 
     parser.add_argument("--test", action="store_true",
                         help="Test, don't send to DB")
@@ -51,9 +200,33 @@ if __name__ == "__main__":
     if args.verbose:
         dbAccess.verbose = True
 
+    if args.no_cache:
+        dbAccess.use_cache = False
+
     if os.getenv("ITK_DB_AUTH"):
         dbAccess.token = os.getenv("ITK_DB_AUTH")
 
+    if args.test_files:
+        files = find_test_files(args.test_files)
+        if not files:
+            print("No test files found")
+            sys.exit(1)
+
+        schemas = None
+        if args.component_type:
+            schemas = TestSchemas(args.component_type, args.project)
+        else:
+            print("No --component-type, only checking the basic structure")
+
+        valid = validate_files(files, schemas)
+        print("%d of %d files are valid" % (len(valid), len(files)))
+
+        if args.test:
+            sys.exit(0 if len(valid) == len(files) else 1)
+
+        failed = upload_files(valid, args.jobs, args.log) if valid else 0
+        sys.exit(1 if failed or len(valid) < len(files) else 0)
+
     if not args.test_file:
         print("Need test file to upload, see test_prototype.py'")
         sys.exit(1)